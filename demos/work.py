@@ -8,7 +8,6 @@
 
 
 from dotenv import load_dotenv
-load_dotenv('../.env')
 
 
 # ## Data Models
@@ -81,12 +80,24 @@ class ProjectApprovation(BaseModel):
 
 
 
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStore
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import threading
 import typing
+from collections import OrderedDict
+import numpy as np
 
 T = typing.TypeVar('T')
 
 class MyVectorStores:
+    names = ('subcategories', 'reprovation_reasons', 'approved_projects', 'reproved_projects')
+
     def __init__(
             self,
             subcategories: VectorStore,
@@ -97,54 +108,1290 @@ class MyVectorStores:
         self.reprovation_reasons = reprovation_reasons
         self.approved_projects = approved_projects
         self.reproved_projects = reproved_projects
+        # Amount of documents in each collection, refreshed by the ingestion paths
+        self.counts = {name: self.fetch_count(name) for name in self.names}
+
+    def fetch_count(self, name: str) -> int:
+        store = getattr(self, name)
+
+        # Counted without listing the ids
+        if isinstance(store, Chroma):
+            return store._collection.count()
+        if isinstance(store, NumpyVectorStore):
+            return len(store.ids)
+        if isinstance(store, HnswVectorStore):
+            return len(store.labels)
+
+        return len(store.get(include=[])['ids'])
+
+    def refresh_count(self, name: str):
+        self.counts[name] = self.fetch_count(name)
+
+    def count(self, name: str) -> int:
+        return self.counts[name]
+
+    def persist(self):
+        """Save the stores that keep their writes in memory until asked to (the HNSW ones)."""
+        for name in self.names:
+            store = getattr(self, name)
+
+            if isinstance(store, HnswVectorStore):
+                store.persist()
+
+class QueryEmbeddings:
+    """Embeddings of the queries made in a single request."""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self.vectors: dict[str, list[float]] = {}
+        self.token: contextvars.Token | None = None
+
+    def embed(self, query: str):
+        if query not in self.vectors:
+            self.vectors[query] = self.embeddings.embed_query(query)
+        return self.vectors[query]
+
+    async def aembed(self, query: str):
+        if query not in self.vectors:
+            self.vectors[query] = await self.embeddings.aembed_query(query)
+        return self.vectors[query]
+
+    def __enter__(self):
+        self.token = current_query_embeddings.set(self)
+        return self
+
+    def __exit__(self, *args):
+        if self.token is not None:
+            current_query_embeddings.reset(self.token)
+            self.token = None
+
+current_query_embeddings: contextvars.ContextVar[QueryEmbeddings | None] = contextvars.ContextVar(
+    'current_query_embeddings', default=None)
+
+def mmr_select(query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float = 0.5) -> list[int]:
+    """Greedy maximal marginal relevance over a matrix of candidates (one row each)."""
+    if not len(candidates) or k <= 0:
+        return []
+
+    norms = np.linalg.norm(candidates, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    candidates = candidates / norms
+    query_norm = np.linalg.norm(query)
+    relevance = candidates @ (query / query_norm if query_norm else query)
+    max_similarity = np.full(len(candidates), -np.inf)
+    available = np.ones(len(candidates), dtype=bool)
+    selected: list[int] = []
+
+    for _ in range(min(k, len(candidates))):
+        if selected:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        else:
+            scores = relevance.copy()
+
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, candidates @ candidates[best])
+
+    return selected
+
+def to_compact(item: BaseModel) -> list:
+    """The field values of the model, in the order of its fields (nested models included), without the field names."""
+    return [
+        to_compact(value) if isinstance(value, BaseModel) else value
+        for value in (getattr(item, name) for name in item.__fields__)
+    ]
+
+def from_compact(model: type[BaseModel], data: list):
+    values = {}
+
+    for (name, field), value in zip(model.__fields__.items(), data):
+        is_model = isinstance(field.type_, type) and issubclass(field.type_, BaseModel)
+        values[name] = from_compact(field.type_, value) if is_model and value is not None else value
+
+    # The data was validated when stored, so it does not need to be validated again
+    return model.construct(**values)
+
+def compact_dumps(item: BaseModel):
+    return json.dumps(to_compact(item), ensure_ascii=False, separators=(',', ':'))
+
+@functools.lru_cache(maxsize=None)
+def schema_fingerprint(model: type[BaseModel]) -> str:
+    """Hash of the field names of the model (nested models included), which define the positions in the compact payload."""
+    def names(model: type[BaseModel]) -> list:
+        return [
+            [name, names(field.type_)] if isinstance(field.type_, type) and issubclass(field.type_, BaseModel) else name
+            for name, field in model.__fields__.items()
+        ]
+
+    return hashlib.sha256(json.dumps(names(model)).encode('utf-8')).hexdigest()[:16]
+
+class LazyItem(typing.Generic[T]):
+    """A stored item that is only decoded when one of its fields (other than the id) is accessed.
+
+    Only the public fields and methods are forwarded; `value()` gives the model itself (e.g. for `isinstance`).
+    """
+
+    __slots__ = ('id', 'decode', 'decoded')
+
+    def __init__(self, id: typing.Any, decode: typing.Callable[[], T]):
+        self.id = id
+        self.decode = decode
+        self.decoded: T | None = None
+
+    @classmethod
+    def loaded(cls, id: typing.Any, value: T) -> 'LazyItem[T]':
+        item = cls(id, lambda: value)
+        item.decoded = value
+        return item
+
+    def value(self) -> T:
+        if self.decoded is None:
+            self.decoded = self.decode()
+        return self.decoded
+
+    def __getattr__(self, name: str):
+        # Called for the unset slots too (in a copy still being created), which must not decode
+        if name.startswith('_') or name in LazyItem.__slots__:
+            raise AttributeError(name)
+        return getattr(self.value(), name)
+
+    def __reduce__(self):
+        # The decode function may not be picklable, so copies and pickles carry the decoded value
+        return (LazyItem.loaded, (self.id, self.value()))
+
+    def __eq__(self, other: object):
+        return self.value() == (other.value() if isinstance(other, LazyItem) else other)
+
+    def __repr__(self):
+        return repr(self.value())
+
+def partition_metadata(item: BaseModel) -> dict[str, typing.Any]:
+    """Metadata used to filter the searches (projects are partitioned by the input subcategory and private flag)."""
+    if isinstance(item, ProjectApprovation):
+        return dict(subcategory=item.input.subcategory, private=item.input.private)
+    return {}
+
+def item_metadata(id: int, text: str, item: BaseModel):
+    payload = compact_dumps(item)
+    schema = schema_fingerprint(type(item))
+    extra = partition_metadata(item)
+    # The schema is part of the hash, so that the items are written again (by upsert_items) when the model changes
+    content = f'{text}\0{schema}\0{payload}\0{sorted(extra.items())}'
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return dict(id=id, payload=payload, schema=schema, hash=content_hash, **extra)
+
+def filter_conditions(filter: dict) -> list[tuple[str, typing.Any]]:
+    """The (key, value) equalities of a filter (in the Chroma `where` format), with the `$and`s flattened."""
+    return [
+        condition
+        for key, value in filter.items()
+        for condition in (
+            [condition for item in value for condition in filter_conditions(item)] if key == '$and' else [(key, value)]
+        )
+    ]
+
+def metadata_filter(**conditions: typing.Any):
+    """Filter (in the Chroma `where` format) matching the documents with all the given metadata values."""
+    if len(conditions) <= 1:
+        return conditions or None
+    return {'$and': [{key: value} for key, value in conditions.items()]}
+
+def project_filters(input: ProjectInput):
+    """Filters for the projects similar to the input, from the narrowest to the widest."""
+    return [
+        metadata_filter(subcategory=input.subcategory, private=input.private),
+        metadata_filter(private=input.private),
+        None,
+    ]
 
 class VectorStoreHandler(typing.Generic[T]):
-    def __init__(self, store: VectorStore, json_parser: typing.Callable[[str], T]):
+    def __init__(self, store: VectorStore, model: type[T], max_index_items: int | None = 10000):
         self.store = store
-        self.json_parser = json_parser
+        self.model = model
+        # Recently used items by id (None when the id is known to not exist in the store), without a limit when None
+        self.max_index_items = max_index_items
+        self.index: OrderedDict[str, LazyItem[T] | None] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def decode(self, metadata: dict):
+        payload = metadata.get('payload')
+
+        if payload is not None:
+            return typing.cast(T, from_compact(self.model, json.loads(payload)))
+
+        # Documents stored before the compact payload was introduced
+        return typing.cast(T, self.model.parse_raw(metadata['json']))
+
+    def item(self, metadata: dict | None):
+        """The item stored in the metadata, decoded only when its fields are accessed."""
+        if not metadata:
+            return None
+
+        if 'payload' in metadata:
+            # A payload stored with other fields (or in another order) can not be decoded by position
+            # (it is ignored until the item is ingested again)
+            if metadata.get('schema') != schema_fingerprint(self.model):
+                return None
+        elif 'json' not in metadata:
+            return None
+
+        return LazyItem(metadata.get('id'), lambda: self.decode(metadata))
+
+    def load_index(self):
+        """Load every item of the store into the id index (meant for the small stores, with no index limit)."""
+        data = self.store.get(include=['metadatas'])
+
+        with self.lock:
+            self.index.clear()
+
+            for id, metadata in zip(data['ids'], data['metadatas'] or []):
+                self._remember(id, self.item(metadata))
+
+    def invalidate(self, ids: typing.Iterable[int | str] | None = None):
+        with self.lock:
+            if ids is None:
+                self.index.clear()
+            else:
+                for id in ids:
+                    self.index.pop(str(id), None)
+
+    def _remember(self, key: str, item: LazyItem[T] | None):
+        self.index[key] = item
+        self.index.move_to_end(key)
+
+        while self.max_index_items is not None and len(self.index) > self.max_index_items:
+            self.index.popitem(last=False)
+
+    def get_many(self, ids: list[int]) -> list[LazyItem[T] | None]:
+        keys = [str(id) for id in ids]
+        items: dict[str, LazyItem[T] | None] = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.index:
+                    self.index.move_to_end(key)
+                    items[key] = self.index[key]
+
+        missing = list(dict.fromkeys(key for key in keys if key not in items))
+
+        if missing:
+            data = self.store.get(ids=missing, include=['metadatas'])
+            found = dict(zip(data['ids'], data['metadatas'] or []))
+
+            with self.lock:
+                for key in missing:
+                    items[key] = self.item(found.get(key))
+                    self._remember(key, items[key])
+
+        return [items[key] for key in keys]
         
-    def get_by_id(self, id: int):
-        data = self.store.get(ids=[str(id)])
-        metadatas = data['metadatas']
-        metadata = metadatas[0] if len(metadatas or []) else None
-        json_data = metadata['json'] if metadata else None
-        data = self.json_parser(json_data) if json_data else None
-        return data
+    def get_by_id(self, id: int) -> LazyItem[T] | None:
+        return self.get_many([id])[0]
+
+    def add_texts(self, ids: list[int], texts: list[str], metadatas: list[dict]):
+        if ids:
+            self.store.add_texts(ids=[str(id) for id in ids], texts=texts, metadatas=metadatas)
+            self.invalidate(ids)
+
+    def add_items(self, ids: list[int], texts: list[str], items: list[BaseModel]):
+        self.add_texts(ids, texts, [item_metadata(id, text, item) for id, text, item in zip(ids, texts, items)])
+
+    def delete(self, ids: list[int]):
+        """Delete the items that exist in the store. Returns the amount deleted."""
+        if not ids:
+            return 0
+
+        existing = self.store.get(ids=[str(id) for id in ids], include=[])['ids']
+
+        if existing:
+            self.store.delete(ids=existing)
+
+        self.invalidate(ids)
+        return len(existing)
+
+    def upsert_items(self, ids: list[int], texts: list[str], items: list[BaseModel]):
+        """Add or update the items, skipping the ones whose content did not change. Returns the amount written."""
+        # An id repeated in the batch keeps only its last item
+        positions = sorted({str(id): idx for idx, id in enumerate(ids)}.values())
+        ids = [ids[idx] for idx in positions]
+        texts = [texts[idx] for idx in positions]
+        items = [items[idx] for idx in positions]
+        metadatas = [item_metadata(id, text, item) for id, text, item in zip(ids, texts, items)]
+        existing = self.store.get(ids=[str(id) for id in ids], include=['metadatas'])
+        existing_hashes = {
+            id: (metadata or {}).get('hash')
+            for id, metadata in zip(existing['ids'], existing['metadatas'] or [])
+        }
+        changed = [
+            idx for idx, metadata in enumerate(metadatas)
+            if existing_hashes.get(str(ids[idx])) != metadata['hash']
+        ]
+
+        self.add_texts(
+            [ids[idx] for idx in changed],
+            [texts[idx] for idx in changed],
+            [metadatas[idx] for idx in changed])
+
+        return len(changed)
+
+    def parse_documents(self, documents: list[Document]) -> list[LazyItem[T]]:
+        items = (self.item(document.metadata) for document in documents)
+        return [typing.cast(LazyItem[T], item) for item in items if item is not None]
+
+    def similarity_search_documents(
+            self,
+            query: str,
+            k: int = 5,
+            filter: dict | None = None):
+        query_embeddings = current_query_embeddings.get()
+
+        if query_embeddings:
+            return self.store.similarity_search_by_vector(query_embeddings.embed(query), k=k, filter=filter)
+
+        return self.store.similarity_search(query, k=k, filter=filter)
+
+    async def asimilarity_search_documents(
+            self,
+            query: str,
+            k: int = 5,
+            filter: dict | None = None):
+        query_embeddings = current_query_embeddings.get()
+
+        if query_embeddings:
+            return await self.store.asimilarity_search_by_vector(await query_embeddings.aembed(query), k=k, filter=filter)
+
+        return await self.store.asimilarity_search(query, k=k, filter=filter)
     
     def similarity_search(
             self, 
             query: str, 
-            k: int = 5):
-        documents = self.store.similarity_search(query, k=k)
-        return list(map(lambda d: self.json_parser(d.metadata['json']), documents))
+            k: int = 5,
+            filter: dict | None = None):
+        documents = self.similarity_search_documents(query, k=k, filter=filter)
+        return self.parse_documents(documents)
     
     async def asimilarity_search(
             self, 
             query: str, 
-            k: int = 5):
-        documents = await self.store.asimilarity_search(query, k=k)
-        return list(map(lambda d: self.json_parser(d.metadata['json']), documents))
+            k: int = 5,
+            filter: dict | None = None):
+        documents = await self.asimilarity_search_documents(query, k=k, filter=filter)
+        return self.parse_documents(documents)
+
+    async def asimilarity_search_widening(
+            self,
+            query: str,
+            k: int = 5,
+            filters: list[dict | None] | None = None):
+        """Search with each filter in turn (from the narrowest to the widest) until k items are found."""
+        documents: dict[str, Document] = {}
+
+        for filter in filters or [None]:
+            for document in await self.asimilarity_search_documents(query, k=k, filter=filter):
+                documents.setdefault(str(document.metadata.get('id')), document)
+
+            if len(documents) >= k:
+                break
+
+        return self.parse_documents(list(documents.values())[:k])
+
+    def similarity_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 5,
+            filter: dict | None = None):
+        documents = self.store.similarity_search_by_vector(embedding, k=k, filter=filter)
+        return self.parse_documents(documents)
+
+    async def asimilarity_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 5,
+            filter: dict | None = None):
+        documents = await self.store.asimilarity_search_by_vector(embedding, k=k, filter=filter)
+        return self.parse_documents(documents)
+    
+    def candidates(self, embedding: list[float], fetch_k: int, filter: dict | None = None):
+        """The documents nearest to the embedding, along with their stored vectors (from the same query)."""
+        collection = getattr(self.store, '_collection', None)
+
+        if collection is not None:
+            # Chroma
+            result = collection.query(
+                query_embeddings=[list(embedding)],
+                n_results=fetch_k,
+                where=filter,
+                include=['documents', 'metadatas', 'embeddings'])
+            documents = [
+                Document(page_content=text, metadata=metadata or {})
+                for text, metadata in zip(result['documents'][0], result['metadatas'][0])
+            ]
+            return documents, np.asarray(result['embeddings'][0], dtype=np.float32)
+
+        # Other stores: embed the documents again (usually from the embeddings cache)
+        documents = self.store.similarity_search_by_vector(embedding, k=fetch_k, filter=filter)
+        texts = [document.page_content for document in documents]
+        store_embeddings = self.store.embeddings
+
+        if isinstance(store_embeddings, CachedEmbeddings):
+            return documents, store_embeddings.embed_vectors(texts)
+
+        return documents, np.asarray(store_embeddings.embed_documents(texts), dtype=np.float32)
+
+    def select_documents(self, embedding: list[float], k: int, fetch_k: int, lambda_mult: float, filter: dict | None = None):
+        if isinstance(self.store, (NumpyVectorStore, HnswVectorStore)):
+            # These stores re-rank their own vectors
+            return self.store.max_marginal_relevance_search_by_vector(
+                embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter)
+
+        documents, vectors = self.candidates(embedding, fetch_k, filter=filter)
+
+        if not documents:
+            return []
+
+        selected = mmr_select(np.asarray(embedding, dtype=np.float32), vectors, k, lambda_mult)
+        return [documents[idx] for idx in selected]
+
+    def query_vector(self, query: str):
+        query_embeddings = current_query_embeddings.get()
+        return query_embeddings.embed(query) if query_embeddings else self.store.embeddings.embed_query(query)
+
+    async def aquery_vector(self, query: str):
+        query_embeddings = current_query_embeddings.get()
+        return await query_embeddings.aembed(query) if query_embeddings else await self.store.embeddings.aembed_query(query)
     
     def max_marginal_relevance_search(
             self, 
             query: str, 
-            k: int = 5):
-        documents = self.store.max_marginal_relevance_search(query, k=k)
-        return list(map(lambda d: self.json_parser(d.metadata['json']), documents))
+            k: int = 5,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            filter: dict | None = None):
+        return self.max_marginal_relevance_search_by_vector(
+            self.query_vector(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter)
     
     async def amax_marginal_relevance_search(
             self, 
             query: str, 
-            k: int = 5):
-        documents = await self.store.amax_marginal_relevance_search(query, k=k)
-        return list(map(lambda d: self.json_parser(d.metadata['json']), documents))
+            k: int = 5,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            filter: dict | None = None):
+        return await self.amax_marginal_relevance_search_by_vector(
+            await self.aquery_vector(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter)
+
+    def max_marginal_relevance_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 5,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            filter: dict | None = None):
+        """Diverse results: one search for `fetch_k` candidates, re-ranked locally with mmr_select."""
+        return self.parse_documents(self.select_documents(embedding, k, max(k, fetch_k), lambda_mult, filter))
+
+    async def amax_marginal_relevance_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 5,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            filter: dict | None = None):
+        selected = await asyncio.to_thread(self.select_documents, embedding, k, max(k, fetch_k), lambda_mult, filter)
+        return self.parse_documents(selected)
 
 class MyVectorStoreHandler:
     def __init__(self, stores: MyVectorStores):
-        self.subcategories = VectorStoreHandler(store=stores.subcategories, json_parser=Subcategory.parse_raw)
-        self.reprovation_reasons = VectorStoreHandler(store=stores.reprovation_reasons, json_parser=ReprovationReason.parse_raw)
-        self.approved_projects = VectorStoreHandler(store=stores.approved_projects, json_parser=ProjectApprovation.parse_raw)
-        self.reproved_projects = VectorStoreHandler(store=stores.reproved_projects, json_parser=ProjectApprovation.parse_raw)
+        # The reference stores are small and fully indexed, the project ones keep only their recently used ids
+        self.subcategories = VectorStoreHandler(store=stores.subcategories, model=Subcategory, max_index_items=None)
+        self.reprovation_reasons = VectorStoreHandler(
+            store=stores.reprovation_reasons, model=ReprovationReason, max_index_items=None)
+        self.approved_projects = VectorStoreHandler(store=stores.approved_projects, model=ProjectApprovation)
+        self.reproved_projects = VectorStoreHandler(store=stores.reproved_projects, model=ProjectApprovation)
+
+
+# ## Embeddings Cache
+
+
+
+import os
+import sqlite3
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper with an in-memory LRU tier and a persistent SQLite tier."""
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            model_name: str,
+            db_path: str | None = None,
+            max_memory_items: int = 10000):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+            self.db.commit()
+
+    def key(self, text: str):
+        return hashlib.sha256(f'{self.model_name}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _load(self, keys: list[str]):
+        found: dict[str, np.ndarray] = {}
+
+        for key in keys:
+            vector = self.memory.get(key)
+
+            if vector is not None:
+                self.memory.move_to_end(key)
+                found[key] = vector
+
+        missing = [key for key in keys if key not in found]
+
+        if self.db is not None and missing:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                rows = self.db.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(chunk))})',
+                    chunk,
+                ).fetchall()
+
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    self._remember(key, vector)
+                    found[key] = vector
+
+        return found
+
+    def _store(self, items: dict[str, np.ndarray]):
+        for key, vector in items.items():
+            self._remember(key, vector)
+
+        if self.db is not None and items:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                [(key, vector.tobytes()) for key, vector in items.items()],
+            )
+            self.db.commit()
+
+    def embed_vectors(self, texts: list[str]) -> np.ndarray:
+        """Return the embeddings of the texts as a float32 matrix (one row per text)."""
+        keys = [self.key(text) for text in texts]
+
+        with self.lock:
+            found = self._load(list(dict.fromkeys(keys)))
+
+        pending = {key: text for key, text in zip(keys, texts) if key not in found}
+        self.hits += len(texts) - sum(1 for key in keys if key in pending)
+        self.misses += len(pending)
+
+        if pending:
+            computed = self.embeddings.embed_documents(list(pending.values()))
+            new_items = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(pending.keys(), computed)
+            }
+
+            with self.lock:
+                self._store(new_items)
+
+            found.update(new_items)
+
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        return np.vstack([found[key] for key in keys])
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_vectors(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_vectors([text])[0].tolist()
+
+
+
+# ## In-memory vector store
+
+
+
+import uuid
+
+class NumpyVectorStore(VectorStore):
+    """Exact vector store backed by a contiguous float32 matrix with normalized rows."""
+
+    def __init__(self, embedding: Embeddings, persist_path: str | None = None):
+        self.embedding = embedding
+        self.persist_path = persist_path
+        self.ids: list[str] = []
+        self.texts: list[str] = []
+        self.metadatas: list[dict] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.lock = threading.Lock()
+
+        if persist_path and os.path.exists(persist_path):
+            with open(persist_path, encoding='utf-8') as file:
+                data = json.load(file)
+
+            self.ids = data['ids']
+            self.texts = data['texts']
+            self.metadatas = data['metadatas']
+            self.matrix = np.asarray(data['vectors'], dtype=np.float32).reshape(len(self.ids), -1)
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    @staticmethod
+    def normalize(vectors: np.ndarray):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return (vectors / norms).astype(np.float32)
+
+    def persist(self):
+        if not self.persist_path:
+            return
+
+        os.makedirs(os.path.dirname(self.persist_path) or '.', exist_ok=True)
+        tmp_path = f'{self.persist_path}.tmp'
+
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(dict(
+                ids=self.ids,
+                texts=self.texts,
+                metadatas=self.metadatas,
+                vectors=self.matrix.tolist(),
+            ), file, ensure_ascii=False)
+
+        os.replace(tmp_path, self.persist_path)
+
+    def add_texts(
+            self,
+            texts: typing.Iterable[str],
+            metadatas: list[dict] | None = None,
+            ids: list[str] | None = None,
+            **kwargs: typing.Any) -> list[str]:
+        texts = list(texts)
+        ids = [str(id) for id in ids] if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self.normalize(np.asarray(self.embedding.embed_documents(texts), dtype=np.float32))
+
+        with self.lock:
+            positions = {id: idx for idx, id in enumerate(self.ids)}
+            rows = list(self.matrix) if len(self.ids) else []
+
+            for id, text, metadata, vector in zip(ids, texts, metadatas, vectors):
+                if id in positions:
+                    idx = positions[id]
+                    self.texts[idx] = text
+                    self.metadatas[idx] = metadata
+                    rows[idx] = vector
+                else:
+                    positions[id] = len(self.ids)
+                    self.ids.append(id)
+                    self.texts.append(text)
+                    self.metadatas.append(metadata)
+                    rows.append(vector)
+
+            self.matrix = np.ascontiguousarray(np.vstack(rows), dtype=np.float32) if rows else self.matrix
+            self.persist()
+
+        return ids
+
+    def delete(self, ids: list[str] | None = None, **kwargs: typing.Any):
+        with self.lock:
+            removed = set(str(id) for id in ids) if ids is not None else set(self.ids)
+            keep = [idx for idx, id in enumerate(self.ids) if id not in removed]
+            self.ids = [self.ids[idx] for idx in keep]
+            self.texts = [self.texts[idx] for idx in keep]
+            self.metadatas = [self.metadatas[idx] for idx in keep]
+            self.matrix = np.ascontiguousarray(self.matrix[keep]) if keep else np.zeros((0, 0), dtype=np.float32)
+            self.persist()
+
+        return True
+
+    def get(
+            self,
+            ids: list[str] | None = None,
+            limit: int | None = None,
+            include: list[str] | None = None,
+            **kwargs: typing.Any):
+        """Same (dict) result as `Chroma.get`, so it can be used in its place."""
+        include = ['documents', 'metadatas'] if include is None else include
+
+        with self.lock:
+            if ids is None:
+                positions = list(range(len(self.ids)))
+            else:
+                by_id = {id: idx for idx, id in enumerate(self.ids)}
+                positions = [by_id[str(id)] for id in ids if str(id) in by_id]
+
+            positions = positions[:limit] if limit is not None else positions
+
+            return dict(
+                ids=[self.ids[idx] for idx in positions],
+                documents=[self.texts[idx] for idx in positions] if 'documents' in include else None,
+                metadatas=[self.metadatas[idx] for idx in positions] if 'metadatas' in include else None,
+                embeddings=[self.matrix[idx].tolist() for idx in positions] if 'embeddings' in include else None,
+            )
+
+    @staticmethod
+    def matches(metadata: dict, filter: dict | None) -> bool:
+        """Whether the metadata matches a (Chroma `where` like) filter of equalities, possibly combined with `$and`."""
+        if not filter:
+            return True
+
+        return all(
+            all(NumpyVectorStore.matches(metadata, item) for item in value) if key == '$and'
+            else metadata.get(key) == value
+            for key, value in filter.items()
+        )
+
+    def top_k(self, embedding: list[float] | np.ndarray, k: int, filter: dict | None = None):
+        """Positions and cosine similarities of the k rows most similar to the embedding (most similar first)."""
+        query = self.normalize(np.asarray(embedding, dtype=np.float32))
+
+        with self.lock:
+            matrix = self.matrix
+            allowed = np.array([
+                self.matches(metadata, filter) for metadata in self.metadatas
+            ], dtype=bool) if filter else None
+
+        if not len(matrix) or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        scores = matrix @ query
+
+        if allowed is not None:
+            scores = np.where(allowed, scores, -np.inf)
+            k = min(k, int(allowed.sum()))
+
+            if k <= 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        k = min(k, len(scores))
+        positions = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        positions = positions[np.argsort(-scores[positions])]
+        return positions, scores[positions]
+
+    def document(self, idx: int):
+        return Document(page_content=self.texts[idx], metadata=self.metadatas[idx])
+
+    def similarity_search_with_score_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 4,
+            filter: dict | None = None,
+            **kwargs: typing.Any):
+        positions, scores = self.top_k(embedding, k, filter=filter)
+        return [(self.document(idx), float(score)) for idx, score in zip(positions, scores)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: typing.Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: typing.Any):
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: typing.Any) -> list[Document]:
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k=k, **kwargs)
+
+    async def asimilarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: typing.Any) -> list[Document]:
+        # Searching is fast enough to not be worth a thread
+        return self.similarity_search_by_vector(embedding, k=k, **kwargs)
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs: typing.Any) -> list[Document]:
+        return self.similarity_search_by_vector(await self.embedding.aembed_query(query), k=k, **kwargs)
+
+    def _select_relevance_score_fn(self):
+        # The scores are already cosine similarities
+        return lambda score: score
+
+    def max_marginal_relevance_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 4,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            filter: dict | None = None,
+            **kwargs: typing.Any) -> list[Document]:
+        positions, _ = self.top_k(embedding, fetch_k, filter=filter)
+
+        if not len(positions):
+            return []
+
+        selected = mmr_select(np.asarray(embedding, dtype=np.float32), self.matrix[positions], k, lambda_mult)
+        return [self.document(positions[idx]) for idx in selected]
+
+    def max_marginal_relevance_search(
+            self,
+            query: str,
+            k: int = 4,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            **kwargs: typing.Any) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self.embedding.embed_query(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **kwargs)
+
+    @classmethod
+    def from_texts(
+            cls,
+            texts: list[str],
+            embedding: Embeddings,
+            metadatas: list[dict] | None = None,
+            ids: list[str] | None = None,
+            persist_path: str | None = None,
+            **kwargs: typing.Any):
+        store = cls(embedding=embedding, persist_path=persist_path)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+
+# ## HNSW vector store
+
+
+
+class HnswVectorStore(VectorStore):
+    """Approximate (HNSW) vector store for large collections, backed by `hnswlib` (and SQLite for the documents).
+
+    Items have an index for each partition (by the `partition_keys` of their metadata), so that the searches filtered
+    by a partition do not go through the others. Writes are kept in memory (and in an open SQLite transaction)
+    until `persist()` or `close()`.
+    """
+
+    partition_keys = ('subcategory', 'private')
+
+    def __init__(
+            self,
+            embedding: Embeddings,
+            persist_dir: str | None = None,
+            M: int = 16,
+            ef_construction: int = 200,
+            ef: int = 64,
+            initial_capacity: int = 1000):
+        import hnswlib
+
+        self.hnswlib = hnswlib
+        self.embedding = embedding
+        self.persist_dir = persist_dir
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        # Capacity of each new partition index (doubled when full)
+        self.initial_capacity = initial_capacity
+        self.dim: int | None = None
+        self.labels: dict[str, int] = {}
+        # Metadatas (without the json payload) by label, used to filter the searches
+        self.filter_metadatas: dict[int, dict] = {}
+        # Index, index file, and labels of the (non-deleted) items of each partition
+        self.indexes: dict[tuple, typing.Any] = {}
+        self.index_files: dict[tuple, str] = {}
+        self.partitions: dict[tuple, set[int]] = {}
+        self.changed_partitions: set[tuple] = set()
+        self.next_label = 0
+        self.lock = threading.RLock()
+
+        db_path = os.path.join(persist_dir, 'documents.sqlite3') if persist_dir else ':memory:'
+
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS documents '
+            '(label INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.db.commit()
+        self.load()
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def partition(self, metadata: dict) -> tuple:
+        return tuple(metadata.get(key) for key in self.partition_keys)
+
+    def load(self):
+        rows = self.db.execute('SELECT label, id, metadata FROM documents').fetchall()
+
+        for label, id, metadata in rows:
+            self.labels[id] = label
+            self.add_filter_metadata(label, json.loads(metadata))
+            self.next_label = max(self.next_label, label + 1)
+
+        settings = dict(self.db.execute('SELECT key, value FROM settings').fetchall())
+
+        if 'dim' in settings:
+            self.dim = int(settings['dim'])
+
+        for partition, file_name in json.loads(settings.get('partitions', '[]')):
+            path = os.path.join(self.persist_dir, file_name) if self.persist_dir else None
+
+            if path and os.path.exists(path):
+                index = self.hnswlib.Index(space='cosine', dim=self.dim)
+                index.load_index(path)
+                index.set_ef(self.ef)
+                self.indexes[tuple(partition)] = index
+                self.index_files[tuple(partition)] = file_name
+
+    def persist(self):
+        """Save the changed indexes and commit the documents (the indexes first, so that they never miss committed documents)."""
+        with self.lock:
+            if self.persist_dir:
+                for partition in self.changed_partitions:
+                    path = os.path.join(self.persist_dir, self.index_files[partition])
+                    self.indexes[partition].save_index(f'{path}.tmp')
+                    os.replace(f'{path}.tmp', path)
+
+                self.db.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES ('partitions', ?)",
+                    (json.dumps([[list(partition), file_name] for partition, file_name in self.index_files.items()]),))
+
+            self.changed_partitions.clear()
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.persist()
+            self.db.close()
+
+    def add_filter_metadata(self, label: int, metadata: dict):
+        filter_metadata = {key: value for key, value in metadata.items() if key not in ('payload', 'json')}
+        self.filter_metadatas[label] = filter_metadata
+        self.partitions.setdefault(self.partition(filter_metadata), set()).add(label)
+
+    def remove_label(self, label: int):
+        partition = self.partition(self.filter_metadatas.pop(label, {}))
+        self.indexes[partition].mark_deleted(label)
+        self.changed_partitions.add(partition)
+        self.partitions[partition].discard(label)
+
+        if not self.partitions[partition]:
+            del self.partitions[partition]
+
+        self.db.execute('DELETE FROM documents WHERE label = ?', (label,))
+
+    def partition_index(self, partition: tuple, amount: int):
+        """The index of the partition, created or resized to fit `amount` more items."""
+        index = self.indexes.get(partition)
+
+        if index is None:
+            index = self.hnswlib.Index(space='cosine', dim=self.dim)
+            index.init_index(
+                max_elements=max(self.initial_capacity, amount),
+                ef_construction=self.ef_construction,
+                M=self.M)
+            index.set_ef(self.ef)
+            self.indexes[partition] = index
+            self.index_files[partition] = f'index-{len(self.index_files)}.bin'
+        elif index.get_current_count() + amount > index.get_max_elements():
+            index.resize_index(max(2 * index.get_max_elements(), index.get_current_count() + amount))
+
+        self.changed_partitions.add(partition)
+        return index
+
+    def add_texts(
+            self,
+            texts: typing.Iterable[str],
+            metadatas: list[dict] | None = None,
+            ids: list[str] | None = None,
+            **kwargs: typing.Any) -> list[str]:
+        texts = list(texts)
+
+        if not texts:
+            return []
+
+        ids = [str(id) for id in ids] if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+
+        # An id repeated in the batch keeps only its last item
+        positions = sorted({id: idx for idx, id in enumerate(ids)}.values())
+
+        if len(positions) < len(ids):
+            texts = [texts[idx] for idx in positions]
+            metadatas = [metadatas[idx] for idx in positions]
+            ids = [ids[idx] for idx in positions]
+
+        vectors = np.asarray(self.embedding.embed_documents(texts), dtype=np.float32)
+
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self.db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('dim', ?)", (str(self.dim),))
+
+            # Positions and labels of the items of each partition
+            batches: dict[tuple, list[tuple[int, int]]] = {}
+
+            for idx, (id, text, metadata) in enumerate(zip(ids, texts, metadatas)):
+                previous = self.labels.get(id)
+
+                # Updated items get a new label (hnswlib does not update in place, and the partition may change)
+                if previous is not None:
+                    self.remove_label(previous)
+
+                label = self.next_label
+                self.next_label += 1
+                self.labels[id] = label
+                self.add_filter_metadata(label, metadata)
+                batches.setdefault(self.partition(metadata), []).append((idx, label))
+                self.db.execute(
+                    'INSERT INTO documents (label, id, text, metadata) VALUES (?, ?, ?, ?)',
+                    (label, id, text, json.dumps(metadata, ensure_ascii=False)))
+
+            for partition, batch in batches.items():
+                self.partition_index(partition, len(batch)).add_items(
+                    vectors[[idx for idx, _ in batch]],
+                    np.asarray([label for _, label in batch], dtype=np.int64))
+
+        return ids
+
+    def delete(self, ids: list[str] | None = None, **kwargs: typing.Any):
+        with self.lock:
+            for id in (ids if ids is not None else list(self.labels)):
+                label = self.labels.pop(str(id), None)
+
+                if label is not None:
+                    self.remove_label(label)
+
+        return True
+
+    def documents_by_label(self, labels: list[int]):
+        if not labels:
+            return {}
+
+        with self.lock:
+            rows = self.db.execute(
+                f'SELECT label, text, metadata FROM documents WHERE label IN ({",".join("?" * len(labels))})',
+                [int(label) for label in labels],
+            ).fetchall()
+
+        return {
+            label: Document(page_content=text, metadata=json.loads(metadata))
+            for label, text, metadata in rows
+        }
+
+    def get(
+            self,
+            ids: list[str] | None = None,
+            limit: int | None = None,
+            include: list[str] | None = None,
+            **kwargs: typing.Any):
+        """Same (dict) result as `Chroma.get`, so it can be used in its place."""
+        include = ['documents', 'metadatas'] if include is None else include
+
+        with self.lock:
+            if ids is None:
+                query = 'SELECT id, text, metadata FROM documents ORDER BY label'
+                rows = self.db.execute(query + (f' LIMIT {int(limit)}' if limit is not None else '')).fetchall()
+            else:
+                keys = [str(id) for id in ids]
+                rows = self.db.execute(
+                    f'SELECT id, text, metadata FROM documents WHERE id IN ({",".join("?" * len(keys))})',
+                    keys,
+                ).fetchall() if keys else []
+                rows = rows[:limit] if limit is not None else rows
+
+        return dict(
+            ids=[id for id, _, _ in rows],
+            documents=[text for _, text, _ in rows] if 'documents' in include else None,
+            metadatas=[json.loads(metadata) for _, _, metadata in rows] if 'metadatas' in include else None,
+        )
+
+    def partition_knn(self, index: typing.Any, query: np.ndarray, k: int, allowed: typing.Callable[[int], bool] | None):
+        # hnswlib fails when the search does not reach k items (it may happen in filtered searches)
+        while k > 0:
+            try:
+                labels, distances = index.knn_query(query, k=k, filter=allowed)
+                return list(zip(labels[0].tolist(), distances[0].tolist()))
+            except RuntimeError:
+                k -= 1
+
+        return []
+
+    def knn(self, embedding: list[float] | np.ndarray, k: int, filter: dict | None = None):
+        """Labels and cosine distances of (approximately) the k nearest items (nearest first)."""
+        if k <= 0:
+            return [], []
+
+        conditions = filter_conditions(filter) if filter else []
+        positions = {key: idx for idx, key in enumerate(self.partition_keys)}
+        partition_conditions = [(positions[key], value) for key, value in conditions if key in positions]
+        # Conditions on other keys are checked for each item (by hnswlib, so prefer filtering by partition)
+        other_conditions = [(key, value) for key, value in conditions if key not in positions]
+        allowed = (
+            lambda label: all(self.filter_metadatas[label].get(key) == value for key, value in other_conditions)
+        ) if other_conditions else None
+        query = np.asarray(embedding, dtype=np.float32)
+        results = []
+
+        with self.lock:
+            for partition, labels in self.partitions.items():
+                if all(partition[idx] == value for idx, value in partition_conditions):
+                    total = sum(map(allowed, labels)) if allowed else len(labels)
+                    results.extend(self.partition_knn(self.indexes[partition], query, min(k, total), allowed))
+
+        results = sorted(results, key=lambda result: result[1])[:k]
+        return [label for label, _ in results], [distance for _, distance in results]
+
+    def vectors(self, labels: list[int]) -> np.ndarray:
+        """The (normalized) vectors of the items, from the indexes of their partitions."""
+        by_partition: dict[tuple, list[int]] = {}
+        vectors = {}
+
+        with self.lock:
+            for label in labels:
+                by_partition.setdefault(self.partition(self.filter_metadatas[label]), []).append(label)
+
+            for partition, partition_labels in by_partition.items():
+                vectors.update(zip(partition_labels, self.indexes[partition].get_items(partition_labels)))
+
+        return np.asarray([vectors[label] for label in labels], dtype=np.float32)
+
+    def similarity_search_with_score_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 4,
+            filter: dict | None = None,
+            **kwargs: typing.Any):
+        labels, distances = self.knn(embedding, k, filter=filter)
+        documents = self.documents_by_label(labels)
+        return [
+            (documents[label], float(distance))
+            for label, distance in zip(labels, distances)
+            if label in documents
+        ]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: typing.Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: typing.Any):
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: typing.Any) -> list[Document]:
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k=k, **kwargs)
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    def max_marginal_relevance_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 4,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            filter: dict | None = None,
+            **kwargs: typing.Any) -> list[Document]:
+        labels, _ = self.knn(embedding, fetch_k, filter=filter)
+
+        if not labels:
+            return []
+
+        vectors = self.vectors(labels)
+        selected = mmr_select(np.asarray(embedding, dtype=np.float32), vectors, k, lambda_mult)
+        documents = self.documents_by_label([labels[idx] for idx in selected])
+        return [documents[labels[idx]] for idx in selected if labels[idx] in documents]
+
+    def max_marginal_relevance_search(
+            self,
+            query: str,
+            k: int = 4,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            **kwargs: typing.Any) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self.embedding.embed_query(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **kwargs)
+
+    @classmethod
+    def from_texts(
+            cls,
+            texts: list[str],
+            embedding: Embeddings,
+            metadatas: list[dict] | None = None,
+            ids: list[str] | None = None,
+            **kwargs: typing.Any):
+        store = cls(embedding=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+def benchmark_ann(
+        vectors: np.ndarray | None = None,
+        size: int = 10000,
+        dim: int = 384,
+        queries: int = 200,
+        k: int = 20,
+        M_values: tuple[int, ...] = (8, 16, 32),
+        ef_values: tuple[int, ...] = (16, 32, 64, 128, 256),
+        ef_construction: int = 200,
+        seed: int = 1):
+    """Recall@k and query latency of HNSW indexes (for each M and ef) against the exact search."""
+    import hnswlib
+
+    rng = np.random.default_rng(seed)
+    data = vectors if vectors is not None else rng.standard_normal((size, dim))
+    data = NumpyVectorStore.normalize(np.asarray(data, dtype=np.float32))
+    query_vectors = data[rng.choice(len(data), size=min(queries, len(data)), replace=False)]
+    query_vectors = NumpyVectorStore.normalize(
+        query_vectors + 0.1 * rng.standard_normal(query_vectors.shape).astype(np.float32))
+    k = min(k, len(data))
+
+    # The exact search is also timed one query at a time, like the HNSW ones
+    expected = []
+    exact_latencies = []
+
+    for query in query_vectors:
+        start = time.perf_counter()
+        scores = data @ query
+        expected.append(np.argpartition(-scores, k - 1)[:k])
+        exact_latencies.append(time.perf_counter() - start)
+
+    exact_latency = float(np.mean(exact_latencies))
+
+    results = []
+
+    for M in M_values:
+        index = hnswlib.Index(space='cosine', dim=data.shape[1])
+        index.init_index(max_elements=len(data), ef_construction=ef_construction, M=M)
+        build_start = time.perf_counter()
+        index.add_items(data, np.arange(len(data)))
+        build_time = time.perf_counter() - build_start
+
+        for ef in ef_values:
+            index.set_ef(max(ef, k))
+            latencies = []
+            hits = 0
+
+            for query, expected_labels in zip(query_vectors, expected):
+                start = time.perf_counter()
+                labels, _ = index.knn_query(query, k=k, num_threads=1)
+                latencies.append(time.perf_counter() - start)
+                hits += len(set(labels[0].tolist()) & set(expected_labels.tolist()))
+
+            results.append(dict(
+                M=M,
+                ef=ef,
+                recall=hits / (k * len(query_vectors)),
+                mean_latency=float(np.mean(latencies)),
+                p95_latency=float(np.percentile(latencies, 95)),
+                build_time=build_time,
+                exact_latency=exact_latency,
+            ))
+
+    return results
 
 
 
@@ -154,24 +1401,48 @@ from langchain_community.embeddings.sentence_transformer import (
     SentenceTransformerEmbeddings,
 )
 
-data_dir = "./data/chroma_db"
-embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+data_path = "./data"
+embeddings_model_name = "all-MiniLM-L6-v2"
 
-def create_store(collection_name):
-    return Chroma(persist_directory=data_dir, collection_name=collection_name, embedding_function=embeddings)
+def create_embeddings():
+    return CachedEmbeddings(
+        SentenceTransformerEmbeddings(model_name=embeddings_model_name),
+        model_name=embeddings_model_name,
+        db_path="./data/embeddings_cache.sqlite3",
+    )
 
-def create_stores():
+def create_store(collection_name, embeddings: Embeddings, path: str = data_path):
+    return Chroma(
+        persist_directory=os.path.join(path, "chroma_db"),
+        collection_name=collection_name,
+        embedding_function=embeddings)
+
+def create_reference_store(collection_name, embeddings: Embeddings, path: str = data_path):
+    return NumpyVectorStore(embedding=embeddings, persist_path=os.path.join(path, "numpy", f"{collection_name}.json"))
+
+def create_projects_store(collection_name, embeddings: Embeddings, path: str = data_path, backend: str | None = None):
+    # Backend of the (large) project collections: "chroma" or "hnsw"
+    if (backend or os.getenv("PROJECTS_STORE_BACKEND", "chroma")) == "hnsw":
+        return HnswVectorStore(
+            embedding=embeddings,
+            persist_dir=os.path.join(path, "hnsw", collection_name),
+            M=int(os.getenv("HNSW_M", "16")),
+            ef_construction=int(os.getenv("HNSW_EF_CONSTRUCTION", "200")),
+            ef=int(os.getenv("HNSW_EF", "64")))
+    return create_store(collection_name, embeddings, path)
+
+def create_stores(embeddings: Embeddings, path: str = data_path, backend: str | None = None):
     stores = MyVectorStores(
-        subcategories=create_store("subcategories"),
-        reprovation_reasons=create_store("reprovation_reasons"),
-        approved_projects=create_store("approved_projects"),
-        reproved_projects=create_store("reproved_projects"),
+        subcategories=create_reference_store("subcategories", embeddings, path),
+        reprovation_reasons=create_reference_store("reprovation_reasons", embeddings, path),
+        approved_projects=create_projects_store("approved_projects", embeddings, path, backend),
+        reproved_projects=create_projects_store("reproved_projects", embeddings, path, backend),
     )
     stores_handler = MyVectorStoreHandler(stores)
+    stores_handler.subcategories.load_index()
+    stores_handler.reprovation_reasons.load_index()
     return stores, stores_handler
 
-stores, stores_handler = create_stores()
-
 
 # ## Examples
 
@@ -394,126 +1665,109 @@ def get_full_examples(amount: int):
     return [get_projects_approvation_full(i) for i in range(amount)]
 
 
-# ## Load Examples
-
-
-
-# Examples of a pretend task of creating antonyms.
-examples = get_full_examples(100)
-
-
-
-
-examples[:2]
-
-
-
-
-[
-    stores.subcategories.add_texts(
-        ids=[str(item.id)], 
-        texts=[item.name], 
-        metadatas=[dict(id=item.id, json=item.json(ensure_ascii=False))]
-    ) for item in get_subcategories()
-]
-[
-    stores.reprovation_reasons.add_texts(
-        ids=[str(item.id)], 
-        texts=[item.name], 
-        metadatas=[dict(id=item.id, json=item.json(ensure_ascii=False))]
-    ) for item in get_reprovation_reasons()
-]
-[
-    stores.approved_projects.add_texts(
-        ids=[str(project_id)], 
-        texts=[data.input.format()], 
-        metadatas=[dict(id=project_id, json=data.json(ensure_ascii=False))]
-    ) for project_id, data in [
-        (project_id, ProjectApprovation(input=input, prediction=output.prediction)) 
-        for project_id, input, output in examples
-        if output.prediction.approve
-    ]
-]
-[
-    stores.reproved_projects.add_texts(
-        ids=[str(project_id)], 
-        texts=[data.input.format()], 
-        metadatas=[dict(id=project_id, json=data.json(ensure_ascii=False))]
-    ) for project_id, data in [
-        (project_id, ProjectApprovation(input=input, prediction=output.prediction)) 
-        for project_id, input, output in examples
-        if not output.prediction.approve
-    ]
-]
-
-stores, stores_handler = create_stores()
-
-
-# ## Print examples loaded from the stores
-
-
-
-from pprint import pprint
-
-
-
-
-pprint(stores_handler.subcategories.similarity_search("design", k=3))
+# ## Ingestion
 
 
 
+import itertools
 
-pprint(stores_handler.reprovation_reasons.similarity_search("duplicado", k=3))
+def read_projects_jsonl(path: str):
+    """Stream (project_id, input, output) tuples from a JSONL file with `id`, `input` and `output` fields."""
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                data = json.loads(line)
+                yield data['id'], ProjectInput.parse_obj(data['input']), ProjectOutput.parse_obj(data['output'])
 
+def ingest_items(handler: VectorStoreHandler, items: typing.Iterable[Subcategory | ReprovationReason], batch_size=500):
+    written = 0
+    iterator = iter(items)
 
+    while batch := list(itertools.islice(iterator, batch_size)):
+        written += handler.upsert_items(
+            ids=[item.id for item in batch],
+            texts=[item.name for item in batch],
+            items=batch)
 
+    return written
 
-pprint(stores_handler.approved_projects.similarity_search("desenho", k=3))
+def ingest_projects(
+        handler: MyVectorStoreHandler,
+        projects: typing.Iterable[tuple[int, ProjectInput, ProjectOutput]],
+        batch_size=500):
+    """Upsert the projects in the approved/reproved stores in batches (one embedding call per batch)."""
+    stats = dict(read=0, written=0, removed=0)
+    # Pending projects by id (a repeated id keeps only its last version)
+    batches: dict[bool, dict[int, ProjectApprovation]] = {True: {}, False: {}}
 
+    def flush(approved: bool):
+        batch = batches[approved]
 
+        if batch:
+            target = handler.approved_projects if approved else handler.reproved_projects
+            other = handler.reproved_projects if approved else handler.approved_projects
+            stats['written'] += target.upsert_items(
+                ids=list(batch),
+                texts=[data.input.format() for data in batch.values()],
+                items=list(batch.values()))
+            stats['removed'] += other.delete(list(batch))
+            batches[approved] = {}
 
+    for project_id, input, output in projects:
+        approved = output.prediction.approve
+        batches[not approved].pop(project_id, None)
+        batches[approved][project_id] = ProjectApprovation(input=input, prediction=output.prediction)
+        stats['read'] += 1
 
-pprint(stores_handler.reproved_projects.similarity_search("website", k=3))
+        if len(batches[approved]) >= batch_size:
+            flush(approved)
 
+    flush(True)
+    flush(False)
 
+    stats['skipped'] = stats['read'] - stats['written']
 
+    return stats
 
-stores_handler.subcategories.similarity_search("design")[0]
-
-
-
-
-stores_handler.reprovation_reasons.similarity_search("duplicado")[0]
-
-
-
-
-stores_handler.approved_projects.similarity_search("desenho")[0]
-
-
-
-
-stores_handler.reproved_projects.similarity_search("website")[0]
-
-
-
-
-stores_handler.subcategories.get_by_id(1)
-
+def ingest_projects_file(path: str, batch_size=500):
+    stats = ingest_projects(service.stores_handler, read_projects_jsonl(path), batch_size=batch_size)
+    service.stores.persist()
+    service.stores.refresh_count('approved_projects')
+    service.stores.refresh_count('reproved_projects')
+    return stats
 
 
+# ## Load Examples
 
-stores_handler.reprovation_reasons.get_by_id(2)
+def load_examples(
+        stores: MyVectorStores,
+        stores_handler: MyVectorStoreHandler,
+        examples: list[tuple[int, ProjectInput, ProjectOutput]]):
+    ingest_items(stores_handler.subcategories, get_subcategories())
+    ingest_items(stores_handler.reprovation_reasons, get_reprovation_reasons())
+    ingest_projects(stores_handler, examples)
+    stores.persist()
 
+    for name in MyVectorStores.names:
+        stores.refresh_count(name)
 
 
+# ## Print examples loaded from the stores
 
-stores_handler.approved_projects.get_by_id(4)
 
 
+from pprint import pprint
 
+def print_examples(stores_handler: MyVectorStoreHandler):
+    pprint(stores_handler.subcategories.similarity_search("design", k=3))
+    pprint(stores_handler.reprovation_reasons.similarity_search("duplicado", k=3))
+    pprint(stores_handler.approved_projects.similarity_search("desenho", k=3))
+    pprint(stores_handler.reproved_projects.similarity_search("website", k=3))
 
-stores_handler.reproved_projects.get_by_id(3)
+    pprint(stores_handler.subcategories.get_by_id(1))
+    pprint(stores_handler.reprovation_reasons.get_by_id(2))
+    pprint(stores_handler.approved_projects.get_by_id(4))
+    pprint(stores_handler.reproved_projects.get_by_id(3))
 
 
 # ## Create the ids mapper prompt
@@ -521,7 +1775,7 @@ stores_handler.reproved_projects.get_by_id(3)
 
 
 async def subcategories_prompt(input_query: str, k=50):    
-    filtered = await stores_handler.subcategories.asimilarity_search(input_query, k=min(k, len(stores.subcategories.get(limit=k)['ids'])))
+    filtered = await service.stores_handler.subcategories.asimilarity_search(input_query, k=min(k, service.stores.count('subcategories')))
     filtered.insert(0, Subcategory(id=0, name="Outra categoria"))
     filtered = sorted(filtered, key=lambda x: x.id)
     result = 'Subcategories ([ID]: [NAME]):\n\n' + '\n'.join([f"{item.id}: {item.name}" for item in filtered])
@@ -531,7 +1785,7 @@ async def subcategories_prompt(input_query: str, k=50):
 
 
 async def reprovation_reasons_prompt(input_query: str, k=50):
-    filtered = await stores_handler.reprovation_reasons.asimilarity_search(input_query, k=min(k, len(stores.reprovation_reasons.get(limit=k)['ids'])))
+    filtered = await service.stores_handler.reprovation_reasons.asimilarity_search(input_query, k=min(k, service.stores.count('reprovation_reasons')))
     
     if not any(item.other for item in filtered):
         filtered.insert(0, ReprovationReason(id=1, name="Outro Motivo", description=""))
@@ -548,14 +1802,106 @@ async def reprovation_reasons_prompt(input_query: str, k=50):
 
 
 
-async def examples_prompt(input_query: str, k=5):
-    approved = await stores_handler.approved_projects.asimilarity_search(input_query, k=k)
-    reproved = await stores_handler.reproved_projects.asimilarity_search(input_query, k=k)
+class TokenCounter:
+    """Counts the tokens of a text with the tokenizer of the model, or estimates them (about 4 characters per token)."""
+
+    def __init__(self, model_name: str = 'gpt-3.5-turbo'):
+        self.model_name = model_name
+        self.encoding: typing.Any = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                try:
+                    import tiktoken
+                    self.encoding = tiktoken.encoding_for_model(self.model_name)
+                except Exception:
+                    # Not installed, unknown model or no network to download the encoding:
+                    # use the estimate (without trying again on every call)
+                    self.encoding = None
+                self.loaded = True
+
+    def __call__(self, text: str) -> int:
+        if not self.loaded:
+            self.load()
+
+        if self.encoding is None:
+            return len(text) // 4 + 1
+
+        return len(self.encoding.encode(text))
+
+count_tokens = TokenCounter()
+
+# Maximum amount of tokens of the examples section (None for no limit)
+examples_token_budget: int | None = 3000
+
+def example_prompt_item(example: ProjectApprovation, compact: bool = False):
+    # The compact form leaves out the fields without value
+    input_json = example.input.json(ensure_ascii=False, exclude_none=compact)
+    prediction_json = example.prediction.json(ensure_ascii=False, exclude_none=compact)
+    return f"Input: {input_json}\nPrediction: {prediction_json}"
+
+def select_examples(
+        groups: list[list[ProjectApprovation]],
+        query_vector: list[float],
+        token_budget: int,
+        compact: bool = False,
+        lambda_mult: float = 0.7,
+        token_counter: typing.Callable[[str], int] = count_tokens):
+    """Pack the most relevant and diverse examples that fit in the token budget."""
+    ranked: list[list[ProjectApprovation]] = []
+
+    for group in groups:
+        if group:
+            vectors = service.embeddings.embed_vectors([example.input.format() for example in group])
+            order = mmr_select(np.asarray(query_vector, dtype=np.float32), vectors, len(group), lambda_mult)
+            ranked.append([group[idx] for idx in order])
+
+    selected: list[str] = []
+    used = 0
+
+    for examples in itertools.zip_longest(*ranked):
+        for example in examples:
+            if example is None:
+                continue
+
+            item = example_prompt_item(example, compact)
+            tokens = token_counter(item)
+
+            if used + tokens <= token_budget:
+                selected.append(item)
+                used += tokens
+
+    return selected
+
+async def examples_prompt(
+        input_query: str,
+        k=5,
+        input: ProjectInput | None = None,
+        token_budget: int | None = None,
+        compact: bool = False):
+    # When the input is known, search first among the projects with the same subcategory and private flag
+    filters = project_filters(input) if input else [None]
+    approved, reproved = await asyncio.gather(
+        service.stores_handler.approved_projects.asimilarity_search_widening(input_query, k=k, filters=filters),
+        service.stores_handler.reproved_projects.asimilarity_search_widening(input_query, k=k, filters=filters),
+    )
+    header = 'Partial examples of inputs and predictions (used for the complete output):\n\n'
 
-    result = 'Partial examples of inputs and predictions (used for the complete output):\n\n' + '\n\n'.join([
-        f"Input: {example.input.json(ensure_ascii=False)}\nPrediction: {example.prediction.json(ensure_ascii=False)}" 
-        for example in (approved + reproved)
-    ])
+    if token_budget is None:
+        items = [example_prompt_item(example, compact) for example in (approved + reproved)]
+    else:
+        query_vector = await service.stores_handler.approved_projects.aquery_vector(input_query)
+        items = await asyncio.to_thread(
+            select_examples,
+            [approved, reproved],
+            query_vector,
+            token_budget - count_tokens(header),
+            compact)
+
+    result = header + '\n\n'.join(items)
 
     return result
 
@@ -580,15 +1926,43 @@ def full_examples_prompt(full_examples: list[tuple[ProjectInput, ProjectOutput]]
 
 from langchain_core.output_parsers.base import BaseOutputParser, T
 
-async def system_prompt(input: ProjectInput, parser: BaseOutputParser[T]):
-    input_query = input.format()
-    subcategories = await subcategories_prompt(input_query, k=50)
-    reprovation_reasons = await reprovation_reasons_prompt(input_query, k=50)
-    examples = await examples_prompt(input_query, k=20)
-    full_examples = full_examples_prompt([(input, output) for _, input, output in get_full_examples(10)])
-    format_instructions = parser.get_format_instructions()
-    
-    result = f"""
+import re
+
+def strip_lines(text: str):
+    return '\n'.join([line.strip() for line in text.split('\n')])
+
+class CompiledPrompt:
+    """A prompt template with its static sections already rendered."""
+
+    def __init__(self, template: str, static_sections: dict[str, str]):
+        self.parts: list[tuple[bool, str]] = []
+
+        for idx, piece in enumerate(re.split(r'\{(\w+)\}', strip_lines(template))):
+            if idx % 2 == 0:
+                self.add_literal(piece)
+            elif piece in static_sections:
+                self.add_literal(strip_lines(static_sections[piece]))
+            else:
+                self.parts.append((False, piece))
+
+    def add_literal(self, text: str):
+        if self.parts and self.parts[-1][0]:
+            self.parts[-1] = (True, self.parts[-1][1] + text)
+        else:
+            self.parts.append((True, text))
+
+    @property
+    def stable_prefix(self):
+        """The rendered text before the first per-request section (the same for every request)."""
+        return self.parts[0][1].lstrip() if self.parts and self.parts[0][0] else ''
+
+    def render(self, **sections: str):
+        return ''.join([
+            value if literal else strip_lines(sections[value])
+            for literal, value in self.parts
+        ]).strip()
+
+system_prompt_template = """
         Return the expected output for the project approvation process based on the input.
 
         The output is composed by a prediction according to the input and additional information about the project.
@@ -620,18 +1994,97 @@ async def system_prompt(input: ProjectInput, parser: BaseOutputParser[T]):
         The result that you return must include both the prediction (as defined in the partial examples above) and the additional information (based on your reasoning) as shown below.
 
         {full_examples}
-    """
+"""
 
-    result = '\n'.join([line.strip() for line in result.split('\n')])
+# Same content, but with every static section before the retrieved ones,
+# so that the prompt prefix can be cached (locally or by the provider)
+prefix_stable_system_prompt_template = """
+        Return the expected output for the project approvation process based on the input.
 
-    return result.strip()
+        The output is composed by a prediction according to the input and additional information about the project.
+
+        This additional information is a meta information given by you according to your reasoning about the project and the prediction itself.
+
+        Projects should be reproved if they ask the freelancer to do something that is specified in the reprovation reasons.
+
+        One peculiar case is for contact information. They should be removed in public projects, but should be allowed in private projects.
+
+        A project asking a specific freelancer to do the job must be private, otherwise it should be reproved.
+        
+        The language of the prediction must be the same as the input language. The default language is Brazilian Portuguese (pt-BR).
+
+        The prediction should change the minimum possible from the input, but it should be improved in terms of grammar and punctuation, if needed.
+
+        You MUST NOT change the meaning of the description. NO MATTER WHAT. If needed, you can define to be reproved if something is really wrong.
+
+        {format_instructions}
+
+        The result that you return must include both the prediction (as defined in the partial examples below) and the additional information (based on your reasoning) as shown below.
+
+        {full_examples}
+
+        Some data in the predictions must be defined as the id based on the following mappings:
+
+        {subcategories}
+
+        {reprovation_reasons}
+
+        {examples}
+"""
+
+PromptLayout = typing.Literal['default', 'prefix_stable']
+
+system_prompt_templates: dict[str, str] = dict(
+    default=system_prompt_template,
+    prefix_stable=prefix_stable_system_prompt_template,
+)
+
+compiled_system_prompts: dict[tuple[type, typing.Any, str], CompiledPrompt] = {}
+
+def get_compiled_system_prompt(parser: BaseOutputParser[T], layout: PromptLayout = 'default'):
+    """Return the system prompt compiled for the parser, rendering the static sections only once per parser type, schema and layout."""
+    key = (type(parser), getattr(parser, 'pydantic_object', None), layout)
+    compiled = compiled_system_prompts.get(key)
+
+    if compiled is None:
+        compiled = CompiledPrompt(system_prompt_templates[layout], dict(
+            format_instructions=parser.get_format_instructions(),
+            full_examples=full_examples_prompt([(input, output) for _, input, output in get_full_examples(10)]),
+        ))
+        compiled_system_prompts[key] = compiled
+
+    return compiled
+
+def stable_prefix_length(parser: BaseOutputParser[T], layout: PromptLayout = 'default'):
+    """Length (in characters) of the system prompt prefix that is the same for every request."""
+    return len(get_compiled_system_prompt(parser, layout).stable_prefix)
+
+async def system_prompt(input: ProjectInput, parser: BaseOutputParser[T], layout: PromptLayout = 'default'):
+    input_query = input.format()
+
+    # Embed the query once and search every store by the same vector
+    with QueryEmbeddings(service.embeddings) as query_embeddings:
+        await query_embeddings.aembed(input_query)
+        subcategories, reprovation_reasons, examples = await asyncio.gather(
+            subcategories_prompt(input_query, k=50),
+            reprovation_reasons_prompt(input_query, k=50),
+            examples_prompt(input_query, k=20, input=input, token_budget=examples_token_budget),
+        )
+
+    compiled = get_compiled_system_prompt(parser, layout)
+    result = compiled.render(
+        subcategories=subcategories,
+        reprovation_reasons=reprovation_reasons,
+        examples=examples)
+
+    return result
 
 def user_prompt(input: ProjectInput):
     formatted_input = full_example_item_prompt(input=input.json(ensure_ascii=False), output='')
     return formatted_input
 
-async def full_prompt(input: ProjectInput, parser: BaseOutputParser[T]):
-    system_prompt_str = await system_prompt(input, parser)
+async def full_prompt(input: ProjectInput, parser: BaseOutputParser[T], layout: PromptLayout = 'default'):
+    system_prompt_str = await system_prompt(input, parser, layout)
     user_prompt_str = user_prompt(input)
     
     result = f"""
@@ -644,21 +2097,534 @@ async def full_prompt(input: ProjectInput, parser: BaseOutputParser[T]):
 
     return result.strip()
 
+# ## Offline LLM
+
+import random
+import time
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LLM
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult, GenerationChunk
+
+LatencyDistribution = typing.Literal['fixed', 'uniform', 'lognormal']
+
+def fake_latency(rng: random.Random, distribution: LatencyDistribution, latency: float, jitter: float):
+    if latency <= 0:
+        return 0.0
+    if distribution == 'uniform':
+        return rng.uniform(max(0.0, latency - jitter), latency + jitter)
+    if distribution == 'lognormal':
+        return latency * rng.lognormvariate(0, jitter)
+    return latency
+
+def fake_approval_output(prompt: str, rng: random.Random, approve_rate: float):
+    """A schema-valid ProjectOutput (as JSON) for the last project input in the prompt."""
+    input = None
+    input_idx = prompt.rfind('Input: ')
+
+    if input_idx >= 0:
+        try:
+            input = ProjectInput.parse_raw(prompt[input_idx + len('Input: '):].split('\n')[0])
+        except ValueError:
+            input = None
+
+    title = input.title if input else 'Projeto de exemplo'
+    description = input.description if input else 'Descrição do projeto de exemplo'
+
+    if rng.random() < approve_rate:
+        prediction = ProjectPrediction(
+            approve=True,
+            subcategory=(input.subcategory if input and input.subcategory else rng.randint(1, 9)),
+            title=title.ljust(25, '.')[:75],
+            description=description.ljust(50, '.')[:2000],
+        )
+    else:
+        prediction = ProjectPrediction(
+            approve=False,
+            reprovation_reason=rng.randint(1, 14),
+            reprovation_comment='Projeto reprovado (resposta simulada).',
+        )
+
+    info = ProjectInfo(
+        reasoning='Resposta simulada.',
+        confidence=round(rng.uniform(0.5, 1), 2),
+        bot_generated=round(rng.uniform(0, 0.5), 2),
+    )
+
+    return ProjectOutput(prediction=prediction, info=info).json(ensure_ascii=False)
+
+def split_tokens(text: str, size: int):
+    return [text[idx:idx + size] for idx in range(0, len(text), size)]
+
+class FakeApprovalResponder:
+    """Deterministic (for the same prompt and seed) response, latency and tokens of the fake models."""
+
+    def __init__(self, prompt: str, seed: int, approve_rate: float, chunk_size: int):
+        digest = hashlib.sha256(f'{seed}\0{prompt}'.encode('utf-8')).digest()
+        self.rng = random.Random(int.from_bytes(digest[:8], 'big'))
+        self.text = fake_approval_output(prompt, self.rng, approve_rate)
+        self.tokens = split_tokens(self.text, chunk_size)
+        self.prompt_tokens = len(prompt) // chunk_size + 1
+
+    def token_usage(self):
+        return dict(
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=len(self.tokens),
+            total_tokens=self.prompt_tokens + len(self.tokens))
+
+class FakeApprovalMixin(BaseModel):
+    """Settings and behaviour shared by the fake models."""
+
+    seed: int = 0
+    approve_rate: float = 0.7
+    # Time to the first token and between tokens (in seconds)
+    latency: float = 0.5
+    latency_jitter: float = 0.5
+    latency_distribution: LatencyDistribution = 'lognormal'
+    token_latency: float = 0.0
+    chunk_size: int = 4
+
+    def responder(self, prompt: str):
+        return FakeApprovalResponder(prompt, self.seed, self.approve_rate, self.chunk_size)
+
+    def first_token_delay(self, responder: FakeApprovalResponder):
+        return fake_latency(responder.rng, self.latency_distribution, self.latency, self.latency_jitter)
+
+    def total_delay(self, responder: FakeApprovalResponder):
+        return self.first_token_delay(responder) + self.token_latency * len(responder.tokens)
+
+def messages_prompt(messages: list[BaseMessage]):
+    return '\n'.join([str(message.content) for message in messages])
+
+class FakeApprovalChatModel(FakeApprovalMixin, BaseChatModel):
+    """Offline chat model that answers with schema-valid ProjectOutput JSON after a simulated latency."""
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-approval-chat'
+
+    def _generate(
+            self,
+            messages: list[BaseMessage],
+            stop: list[str] | None = None,
+            run_manager: CallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> ChatResult:
+        responder = self.responder(messages_prompt(messages))
+        time.sleep(self.total_delay(responder))
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=responder.text))],
+            llm_output=dict(token_usage=responder.token_usage(), model_name=self._llm_type))
+
+    async def _agenerate(
+            self,
+            messages: list[BaseMessage],
+            stop: list[str] | None = None,
+            run_manager: AsyncCallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> ChatResult:
+        responder = self.responder(messages_prompt(messages))
+        await asyncio.sleep(self.total_delay(responder))
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=responder.text))],
+            llm_output=dict(token_usage=responder.token_usage(), model_name=self._llm_type))
+
+    def _stream(
+            self,
+            messages: list[BaseMessage],
+            stop: list[str] | None = None,
+            run_manager: CallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> typing.Iterator[ChatGenerationChunk]:
+        responder = self.responder(messages_prompt(messages))
+        time.sleep(self.first_token_delay(responder))
+
+        for token in responder.tokens:
+            time.sleep(self.token_latency)
+
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(
+            self,
+            messages: list[BaseMessage],
+            stop: list[str] | None = None,
+            run_manager: AsyncCallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> typing.AsyncIterator[ChatGenerationChunk]:
+        responder = self.responder(messages_prompt(messages))
+        await asyncio.sleep(self.first_token_delay(responder))
+
+        for token in responder.tokens:
+            await asyncio.sleep(self.token_latency)
+
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+class FakeApprovalLLM(FakeApprovalMixin, LLM):
+    """Offline completion model that answers with schema-valid ProjectOutput JSON after a simulated latency."""
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-approval'
+
+    def _call(
+            self,
+            prompt: str,
+            stop: list[str] | None = None,
+            run_manager: CallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> str:
+        responder = self.responder(prompt)
+        time.sleep(self.total_delay(responder))
+        return responder.text
+
+    async def _acall(
+            self,
+            prompt: str,
+            stop: list[str] | None = None,
+            run_manager: AsyncCallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> str:
+        responder = self.responder(prompt)
+        await asyncio.sleep(self.total_delay(responder))
+        return responder.text
+
+    def _stream(
+            self,
+            prompt: str,
+            stop: list[str] | None = None,
+            run_manager: CallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> typing.Iterator[GenerationChunk]:
+        responder = self.responder(prompt)
+        time.sleep(self.first_token_delay(responder))
+
+        for token in responder.tokens:
+            time.sleep(self.token_latency)
+
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+
+            yield GenerationChunk(text=token)
+
+    async def _astream(
+            self,
+            prompt: str,
+            stop: list[str] | None = None,
+            run_manager: AsyncCallbackManagerForLLMRun | None = None,
+            **kwargs: typing.Any) -> typing.AsyncIterator[GenerationChunk]:
+        responder = self.responder(prompt)
+        await asyncio.sleep(self.first_token_delay(responder))
+
+        for token in responder.tokens:
+            await asyncio.sleep(self.token_latency)
+
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+
+            yield GenerationChunk(text=token)
+
+# ## Tracing and metrics
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import Runnable, RunnableLambda
+
+class MetricsRegistry:
+    """In-process counters and histograms, exported in the Prometheus text format."""
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets: tuple[float, ...] = default_buckets):
+        self.buckets = buckets
+        self.counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        self.histograms: dict[tuple[str, tuple[tuple[str, str], ...]], list[float]] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, labels: dict[str, str], value: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict[str, str], value: float):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            # Bucket counts (cumulative), followed by the sum and the count
+            histogram = self.histograms.setdefault(key, [0.0] * (len(self.buckets) + 2))
+
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[idx] += 1
+
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def format_labels(labels: typing.Iterable[tuple[str, str]]):
+        def escape(value: str):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        formatted = [f'{name}="{escape(value)}"' for name, value in labels]
+        return '{' + ','.join(formatted) + '}' if formatted else ''
+
+    def export_prometheus(self):
+        lines: list[str] = []
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+
+        typed: set[str] = set()
+
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+
+        for (name, labels), values in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{name}_bucket{self.format_labels(labels + (("le", str(bound)),))} {count}')
+
+            lines.append(f'{name}_bucket{self.format_labels(labels + (("le", "+Inf"),))} {values[-1]}')
+            lines.append(f'{name}_sum{self.format_labels(labels)} {values[-2]}')
+            lines.append(f'{name}_count{self.format_labels(labels)} {values[-1]}')
+
+        return '\n'.join(lines) + '\n'
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records timing, input/output sizes, token counts and errors of every runnable of a chain."""
+
+    run_inline = True
+
+    def __init__(self, registry: MetricsRegistry, span_log_path: str | None = None):
+        self.registry = registry
+        self.span_log_path = span_log_path
+        self.spans: dict[typing.Any, dict[str, typing.Any]] = {}
+        self.lock = threading.Lock()
+
+        if span_log_path:
+            os.makedirs(os.path.dirname(span_log_path) or '.', exist_ok=True)
+
+    def start(self, serialized: dict[str, typing.Any] | None, inputs: typing.Any, run_id, parent_run_id, kind: str, **kwargs):
+        name = kwargs.get('name') or (serialized or {}).get('name') or kind
+        self.spans[run_id] = dict(
+            run_id=str(run_id),
+            parent_run_id=str(parent_run_id) if parent_run_id else None,
+            name=name,
+            kind=kind,
+            start=time.time(),
+            started=time.perf_counter(),
+            input_size=len(str(inputs)),
+        )
+
+    def end(self, run_id, outputs: typing.Any = None, error: BaseException | None = None, tokens: dict[str, int] | None = None):
+        span = self.spans.pop(run_id, None)
+
+        if span is None:
+            return
+
+        span['duration'] = time.perf_counter() - span.pop('started')
+        span['output_size'] = len(str(outputs)) if outputs is not None else 0
+        span['error'] = repr(error) if error else None
+        span['tokens'] = tokens
+        labels = dict(stage=span['name'], kind=span['kind'])
+
+        self.registry.observe('approval_stage_duration_seconds', labels, span['duration'])
+        self.registry.inc('approval_stage_calls_total', labels)
+        self.registry.inc('approval_stage_input_chars_total', labels, span['input_size'])
+        self.registry.inc('approval_stage_output_chars_total', labels, span['output_size'])
+
+        if error:
+            self.registry.inc('approval_stage_errors_total', labels)
+
+        for token_type, count in (tokens or {}).items():
+            self.registry.inc('approval_stage_tokens_total', dict(**labels, type=token_type), count)
+
+        if self.span_log_path:
+            with self.lock, open(self.span_log_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(span, ensure_ascii=False, default=str) + '\n')
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        self.start(serialized, inputs, run_id, parent_run_id, 'chain', **kwargs)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.end(run_id, outputs)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.end(run_id, error=error)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self.start(serialized, prompts, run_id, parent_run_id, 'llm', **kwargs)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self.start(serialized, messages, run_id, parent_run_id, 'llm', **kwargs)
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        token_usage = (response.llm_output or {}).get('token_usage') or {}
+        tokens = {name: int(value) for name, value in token_usage.items() if isinstance(value, (int, float))}
+        self.end(run_id, [[generation.text for generation in generations] for generations in response.generations], tokens=tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.end(run_id, error=error)
+
+def instrument(runnable: Runnable, handler: BaseCallbackHandler):
+    """Attach the handler to the runnable and to every runnable inside it."""
+    return runnable.with_config(callbacks=[handler])
+
+metrics_registry = MetricsRegistry()
+
+tracing_handler = TracingCallbackHandler(metrics_registry)
+
 # ## Create the chain
 
+from langchain_core.output_parsers.json import JsonOutputParser
 from langchain_core.output_parsers.pydantic import PydanticOutputParser
 from langchain_openai import OpenAI, ChatOpenAI
-from langchain_core.runnables import RunnableLambda
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.prompt_values import PromptValue
+
+class LLMResponseCache:
+    """Persistent (SQLite) cache of LLM responses keyed by the model name and the rendered prompt."""
+
+    def __init__(self, db_path: str, ttl: float | None = 7 * 24 * 60 * 60, max_entries: int = 100000):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS llm_cache '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)')
+        self.db.commit()
+
+    def key(self, model_name: str, prompt: str):
+        return hashlib.sha256(f'{model_name}\0{prompt}'.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute('SELECT value, created FROM llm_cache WHERE key = ?', (key,)).fetchone()
+
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self.db.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                self.db.commit()
+                row = None
+            elif row:
+                self.db.execute('UPDATE llm_cache SET accessed = ? WHERE key = ?', (now, key))
+                self.db.commit()
+
+        if row:
+            self.hits += 1
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                (key, value, now, now))
+            self.writes += 1
+
+            # Counting the entries is not free, so the eviction runs only every few writes
+            if self.writes % 100 == 1:
+                self.evict()
+
+            self.db.commit()
+
+    def evict(self):
+        if self.ttl is not None:
+            self.db.execute('DELETE FROM llm_cache WHERE created < ?', (time.time() - self.ttl,))
+
+        count = self.db.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+
+        if count > self.max_entries:
+            self.db.execute(
+                'DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed LIMIT ?)',
+                (count - self.max_entries,))
+
+    @staticmethod
+    def encode(result: BaseMessage | str):
+        # Only the content is stored, so the hits do not need to load serialized langchain objects
+        if isinstance(result, BaseMessage):
+            return json.dumps(dict(message=result.content), ensure_ascii=False)
+        return json.dumps(dict(text=result), ensure_ascii=False)
+
+    @staticmethod
+    def decode(cached: str) -> BaseMessage | str | None:
+        value = json.loads(cached)
+
+        if 'message' in value:
+            return AIMessage(content=value['message'])
+        if 'text' in value:
+            return value['text']
+
+        # Entries in another format (from older versions) are ignored
+        return None
+
+    def wrap(self, llm: BaseLanguageModel):
+        """Return a runnable that answers from the cache, calling the llm only on misses."""
+        model_name = getattr(llm, 'model_name', None) or type(llm).__name__
+
+        def prompt_key(prompt_value: PromptValue | str):
+            prompt_str = prompt_value if isinstance(prompt_value, str) else prompt_value.to_string()
+            return self.key(model_name, prompt_str)
+
+        def invoke(prompt_value: PromptValue | str):
+            key = prompt_key(prompt_value)
+            cached = self.get(key)
+            result = self.decode(cached) if cached is not None else None
+
+            if result is None:
+                result = llm.invoke(prompt_value)
+                self.set(key, self.encode(result))
+
+            return result
+
+        async def ainvoke(prompt_value: PromptValue | str):
+            key = prompt_key(prompt_value)
+            cached = await asyncio.to_thread(self.get, key)
+            result = self.decode(cached) if cached is not None else None
+
+            if result is None:
+                result = await llm.ainvoke(prompt_value)
+                await asyncio.to_thread(self.set, key, self.encode(result))
+
+            return result
+
+        return RunnableLambda(invoke, afunc=ainvoke, name='llm_cache')
 
-def create_chain_parts(chat: bool):
-    parser = PydanticOutputParser(pydantic_object=ProjectOutput)
+def create_chain_parts(
+        chat: bool,
+        layout: PromptLayout = 'default',
+        cache: LLMResponseCache | None = None,
+        llm: BaseLanguageModel | None = None,
+        streaming: bool = False):
+    """Create the prompt, llm (OpenAI by default) and parser (JsonOutputParser with `streaming`) of the approval chain."""
+    prompt_parser = PydanticOutputParser(pydantic_object=ProjectOutput)
+    parser: BaseOutputParser = JsonOutputParser() if streaming else prompt_parser
 
     async def full_prompt_with_parser(input: ProjectInput):
-        return await full_prompt(input=input, parser=parser)
+        return await full_prompt(input=input, parser=prompt_parser, layout=layout)
 
     async def system_prompt_with_parser(input: ProjectInput):
-        return await system_prompt(input=input, parser=parser)
+        return await system_prompt(input=input, parser=prompt_parser, layout=layout)
 
     if chat:
         chat_template = ChatPromptTemplate.from_messages([
@@ -669,16 +2635,713 @@ def create_chain_parts(chat: bool):
             system=RunnableLambda(system_prompt_with_parser),
             human=RunnableLambda(user_prompt),
         ) | chat_template
-        llm = ChatOpenAI(temperature=0, model='gpt-3.5-turbo')
+        llm = llm or ChatOpenAI(temperature=0, model='gpt-3.5-turbo')
     else:
         prompt = RunnableLambda(full_prompt_with_parser)
-        llm = OpenAI(temperature=0)
+        llm = llm or OpenAI(temperature=0)
+
+    if cache and not streaming:
+        llm = cache.wrap(llm)
 
     return prompt, llm, parser
 
-prompt, llm, parser = create_chain_parts(chat=True)
+def create_chain(cache: LLMResponseCache | None = None, streaming: bool = False):
+    prompt, llm, parser = create_chain_parts(chat=True, cache=cache, streaming=streaming)
+    return instrument(prompt | llm | parser, tracing_handler)
+
+# ## Streaming predictions
+
+def complete_prediction_fields(partial_output: dict[str, typing.Any]):
+    """The prediction fields of a partially parsed output whose values are already complete."""
+    prediction = partial_output.get('prediction')
+
+    if not isinstance(prediction, dict):
+        return {}
+
+    keys = list(prediction)
+
+    if 'info' not in partial_output:
+        keys = keys[:-1]
+
+    return {key: prediction[key] for key in keys}
+
+def early_reprovation(fields: dict[str, typing.Any]):
+    """Stop condition for reprovals: the decision and its reason are all that is needed."""
+    return fields.get('approve') is False and fields.get('reprovation_reason') is not None
+
+async def astream_prediction(
+        input: ProjectInput,
+        stop_when: typing.Callable[[dict[str, typing.Any]], bool] | None = None,
+        runnable: Runnable | None = None):
+    """Yield the complete prediction fields of the input each time a new one arrives from the llm."""
+    stream = (runnable or service.streaming_chain).astream(input)
+    last: dict[str, typing.Any] | None = None
+
+    try:
+        async for partial_output in stream:
+            if not isinstance(partial_output, dict):
+                continue
+
+            fields = complete_prediction_fields(partial_output)
 
-chain = prompt | llm | parser
+            if fields != last:
+                last = fields
+                yield fields
+
+                if stop_when and stop_when(fields):
+                    break
+    finally:
+        await stream.aclose()
+
+async def apredict(input: ProjectInput, stop_when: typing.Callable[[dict[str, typing.Any]], bool] | None = early_reprovation):
+    """The prediction of the input, stopping the generation early when `stop_when` is satisfied."""
+    fields: dict[str, typing.Any] = {}
+
+    async for fields in astream_prediction(input, stop_when=stop_when):
+        pass
+
+    return ProjectPrediction.parse_obj(fields)
+
+# ## Semantic decisions cache
+
+def token_substitutions(old: str, new: str):
+    """Map the tokens that differ between two texts with the same shape (None when their shapes differ)."""
+    old_tokens = old.split()
+    new_tokens = new.split()
+
+    if len(old_tokens) != len(new_tokens):
+        return None
+
+    return {
+        old_token: new_token
+        for old_token, new_token in zip(old_tokens, new_tokens)
+        if old_token != new_token
+    }
+
+def substitute_tokens(text: str | None, substitutions: dict[str, str]):
+    if not text or not substitutions:
+        return text
+
+    pattern = '|'.join(re.escape(token) for token in sorted(substitutions, key=len, reverse=True))
+    return re.sub(f'(?<!\\w)(?:{pattern})(?!\\w)', lambda match: substitutions[match.group(0)], text)
+
+class SemanticDecisionCache:
+    """Cache of decisions for near-duplicate projects (with the same subcategory and private flag)."""
+
+    def __init__(
+            self,
+            embeddings: CachedEmbeddings,
+            max_distance: float = 0.05,
+            max_entries: int = 10000):
+        self.embeddings = embeddings
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.entries: dict[tuple[int, bool], list[tuple[ProjectInput, ProjectOutput]]] = {}
+        self.vectors: dict[tuple[int, bool], list[np.ndarray]] = {}
+        self.matrices: dict[tuple[int, bool], np.ndarray] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def metrics(self):
+        return dict(
+            lookups=self.lookups,
+            hits=self.hits,
+            hit_rate=self.hit_rate,
+            entries=sum(len(entries) for entries in self.entries.values()))
+
+    def embed(self, input: ProjectInput):
+        vector = self.embeddings.embed_vectors([input.format()])[0]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def adapt(self, cached_input: ProjectInput, cached_output: ProjectOutput, input: ProjectInput):
+        title_substitutions = token_substitutions(cached_input.title, input.title)
+        description_substitutions = token_substitutions(cached_input.description, input.description)
+
+        if title_substitutions is None or description_substitutions is None:
+            return None
+
+        substitutions = {**title_substitutions, **description_substitutions}
+        prediction = cached_output.prediction.copy(update=dict(
+            title=substitute_tokens(cached_output.prediction.title, substitutions),
+            description=substitute_tokens(cached_output.prediction.description, substitutions),
+            reprovation_comment=substitute_tokens(cached_output.prediction.reprovation_comment, substitutions),
+        ))
+        return cached_output.copy(update=dict(prediction=prediction))
+
+    def lookup(self, input: ProjectInput, serve_approvals: bool = False):
+        key = (input.subcategory, input.private)
+        vector = self.embed(input)
+
+        with self.lock:
+            self.lookups += 1
+            entries = self.entries.get(key)
+
+            if not entries:
+                return None
+
+            matrix = self.matrices.get(key)
+
+            if matrix is None:
+                matrix = self.matrices[key] = np.vstack(self.vectors[key])
+
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+
+            if 1 - similarities[best] > self.max_distance:
+                return None
+
+            cached_input, cached_output = entries[best]
+
+        # An approval only holds if the project is not a repost, which the cache cannot tell
+        if cached_output.prediction.approve and not serve_approvals:
+            return None
+
+        output = self.adapt(cached_input, cached_output, input)
+
+        if output is not None:
+            with self.lock:
+                self.hits += 1
+
+        return output
+
+    def add(self, input: ProjectInput, output: ProjectOutput):
+        key = (input.subcategory, input.private)
+        vector = self.embed(input)
+
+        with self.lock:
+            entries = self.entries.setdefault(key, [])
+            vectors = self.vectors.setdefault(key, [])
+            entries.append((input, output))
+            vectors.append(vector)
+
+            if len(entries) > self.max_entries:
+                del entries[0]
+                del vectors[0]
+
+            self.matrices.pop(key, None)
+
+    def wrap(self, runnable: Runnable, serve_approvals: bool = False):
+        """Return a runnable that answers near-duplicate projects from the cache, calling the runnable otherwise.
+
+        Cached approvals are only served with `serve_approvals`, when the inputs already passed a duplicates check.
+        """
+        def invoke(input: ProjectInput):
+            output = self.lookup(input, serve_approvals)
+
+            if output is None:
+                output = runnable.invoke(input)
+                self.add(input, output)
+
+            return output
+
+        async def ainvoke(input: ProjectInput):
+            output = await asyncio.to_thread(self.lookup, input, serve_approvals)
+
+            if output is None:
+                output = await runnable.ainvoke(input)
+                await asyncio.to_thread(self.add, input, output)
+
+            return output
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+# ## Rule-based pre-filter
+
+import unicodedata
+
+def normalize_text(text: str):
+    """Lowercase text without accents (so that the rules do not depend on them)."""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+negation_words = {'nao', 'sem', 'nem', 'nenhum', 'nenhuma', 'nunca', 'jamais'}
+
+class PrefilterRule:
+    def __init__(
+            self,
+            reprovation_reason: int,
+            comment: str,
+            patterns: list[str],
+            confidence: float = 0.95,
+            negatable: bool = True):
+        self.reprovation_reason = reprovation_reason
+        self.comment = comment
+        self.confidence = confidence
+        # Matches right after or before a negation ("nao e vaga de emprego", "comissionado nao") are left to the llm
+        self.negatable = negatable
+        self.regex = re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+    def negated(self, text: str, start: int, end: int):
+        before = re.findall(r'\w+', text[max(0, start - 40):start])[-3:]
+        after = re.findall(r'\w+', text[end:end + 20])[:1]
+        return any(word in negation_words for word in before + after)
+
+    def matches(self, text: str):
+        return any(
+            not (self.negatable and self.negated(text, match.start(), match.end()))
+            for match in self.regex.finditer(text)
+        )
+
+def get_prefilter_rules():
+    # Patterns are matched against the normalized (lowercase, accentless) title and description, and are anchored
+    # to what the client offers or requires, so that projects about these subjects (a portal of job vacancies,
+    # a commissions calculator, an article about volunteering) are left to the llm
+    return [
+        PrefilterRule(
+            reprovation_reason=8,
+            comment='Testes e trabalhos não remunerados não são permitidos.',
+            # The negation is part of these patterns
+            negatable=False,
+            patterns=[
+                r'\btestes? (?:nao (?:pagos?|remunerados?)|sem (?:remuneracao|pagamento))\b',
+                r'\b(?:fazer|faca|realizar|realize|enviar|envie)\s+(?:\w+\s+){0,2}testes? (?:gratuitos?|sem custo)\b',
+                r'\b(?:trabalho|projeto|servico) (?:sera|e|seria) (?:\w+\s+)?(?:voluntario|gratuito|nao (?:pago|remunerado))\b',
+                r'\bnao (?:ha|havera|tera|oferecemos|podemos oferecer) (?:\w+\s+)?(?:remuneracao|pagamento)\b',
+            ]),
+        PrefilterRule(
+            reprovation_reason=7,
+            comment='Pagamentos via comissão não são permitidos.',
+            patterns=[
+                r'\b(?:pagamento|remuneracao)\s+(?:sera|e|vai ser|seria)\s+(?:feit[oa]\s+)?(?:somente\s+|apenas\s+|so\s+)?(?:por|via|em|com|atraves de)\s+comiss(?:ao|oes)\b',
+                r'\b(?:pago|pagamos|pagarei|pagaremos|remunerado|remuneramos)\s+(?:somente\s+|apenas\s+|so\s+)?(?:por|via|em|com)\s+comiss(?:ao|oes)\b',
+                r'\b(?:somente|apenas)\s+(?:por\s+|via\s+|com\s+)?comiss(?:ao|oes)\b',
+                r'\b(?:voce|freelancer|profissional)\s+(?:ganhara|recebera|ganha|recebe|vai\s+(?:ganhar|receber))\s+(?:\w+\s+){0,2}\d+\s*%\s*(?:de\s+)?comissao\b',
+                r'\b(?:buscamos|procuramos|contratamos|procuro|busco)\s+(?:\w+\s+){0,2}comissionad[oa]s?\b',
+            ]),
+        PrefilterRule(
+            reprovation_reason=10,
+            comment='Vagas de emprego não são permitidas.',
+            patterns=[
+                r'\b(?:vaga|oportunidade|contratamos|contrataremos|contratando|oferecemos|ofereco)\s+(?:\w+\s+){0,3}?(?:clt|carteira assinada)\b',
+                r'\b(?:contrato|contratacao|regime) clt (?:para|com)\b',
+            ]),
+        PrefilterRule(
+            reprovation_reason=9,
+            comment='Permutas não são permitidas.',
+            patterns=[
+                r'\b(?:ofereco|oferecemos|proponho|propomos|aceito|aceitamos)\s+(?:uma\s+)?(?:permuta|troca de (?:servicos|trabalhos?))\b',
+                r'\b(?:pagamento|pago|pagarei|pagaremos|pagamos)\s+(?:sera\s+|e\s+)?(?:feito\s+)?(?:em|via|com|por|atraves de)\s+(?:uma\s+)?(?:permuta|troca de (?:servicos|trabalhos?))\b',
+                r'\b(?:permuta|troca de servicos) (?:como|em) (?:forma de )?pagamento\b',
+            ]),
+    ]
+
+class ProjectPrefilter:
+    """Reproves the projects that match a high-confidence rule without calling the chain."""
+
+    def __init__(self, rules: list[PrefilterRule]):
+        self.rules = rules
+        self.checked = 0
+        self.matched: dict[int, int] = {}
+
+    def check(self, input: ProjectInput):
+        text = normalize_text(f'{input.title}\n{input.description}')
+        self.checked += 1
+
+        for rule in self.rules:
+            if rule.matches(text):
+                self.matched[rule.reprovation_reason] = self.matched.get(rule.reprovation_reason, 0) + 1
+                return ProjectOutput(
+                    prediction=ProjectPrediction(
+                        approve=False,
+                        reprovation_reason=rule.reprovation_reason,
+                        reprovation_comment=rule.comment,
+                    ),
+                    info=ProjectInfo(
+                        reasoning=f'Reprovado pela regra automática do motivo {rule.reprovation_reason}.',
+                        confidence=rule.confidence,
+                        bot_generated=0,
+                    ),
+                )
+
+        return None
+
+    def metrics(self):
+        matched = sum(self.matched.values())
+        return dict(
+            checked=self.checked,
+            matched=matched,
+            match_rate=matched / self.checked if self.checked else 0.0,
+            matched_by_reason=dict(self.matched))
+
+    def wrap(self, runnable: Runnable):
+        def invoke(input: ProjectInput):
+            return self.check(input) or runnable.invoke(input)
+
+        async def ainvoke(input: ProjectInput):
+            return self.check(input) or await runnable.ainvoke(input)
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+def benchmark_prefilter(amount: int = 10000, prefilter: ProjectPrefilter | None = None):
+    """Time the pre-filter alone over synthetic projects."""
+    prefilter = prefilter or ProjectPrefilter(get_prefilter_rules())
+    inputs = [input for _, input, _ in get_full_examples(amount)]
+    durations = []
+
+    for input in inputs:
+        start = time.perf_counter()
+        prefilter.check(input)
+        durations.append(time.perf_counter() - start)
+
+    return dict(
+        amount=amount,
+        mean=float(np.mean(durations)),
+        p50=float(np.percentile(durations, 50)),
+        p99=float(np.percentile(durations, 99)),
+        **prefilter.metrics())
+
+# ## Duplicate projects index
+
+import zlib
+
+class MinHashLSHIndex:
+    """MinHash LSH index of texts for finding near-duplicates (by Jaccard similarity of character shingles)."""
+
+    prime = np.uint64((1 << 61) - 1)
+    max_hash = np.uint64((1 << 32) - 1)
+
+    def __init__(
+            self,
+            num_perm: int = 128,
+            bands: int = 16,
+            shingle_size: int = 5,
+            threshold: float = 0.8,
+            max_entries: int = 1000000,
+            max_age: float | None = None,
+            seed: int = 1):
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 61, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 61, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries: OrderedDict[typing.Hashable, tuple[np.ndarray, float]] = OrderedDict()
+        self.buckets: list[dict[bytes, set[typing.Hashable]]] = [{} for _ in range(bands)]
+        self.lock = threading.Lock()
+
+    def shingles(self, text: str):
+        text = ' '.join(normalize_text(text).split())
+        size = self.shingle_size
+        return {text[idx:idx + size] for idx in range(max(1, len(text) - size + 1))}
+
+    def signature(self, text: str):
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in self.shingles(text)),
+            dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            permuted = (np.outer(self.a, hashes) + self.b[:, None]) % self.prime & self.max_hash
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def band_keys(self, signature: np.ndarray):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _remove(self, key: typing.Hashable):
+        signature, _ = self.entries.pop(key)
+
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            keys = bucket.get(band_key)
+
+            if keys is not None:
+                keys.discard(key)
+
+                if not keys:
+                    del bucket[band_key]
+
+    def _evict(self, now: float):
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+        if self.max_age is not None:
+            while self.entries:
+                key, (_, inserted) = next(iter(self.entries.items()))
+
+                if now - inserted <= self.max_age:
+                    break
+
+                self._remove(key)
+
+    def insert(self, key: typing.Hashable, text: str, signature: np.ndarray | None = None):
+        signature = self.signature(text) if signature is None else signature
+        now = time.time()
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (signature, now)
+
+            for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+                bucket.setdefault(band_key, set()).add(key)
+
+            self._evict(now)
+
+    def query(self, text: str, signature: np.ndarray | None = None):
+        """The indexed keys whose estimated Jaccard similarity with the text is at least the threshold (most similar first)."""
+        signature = self.signature(text) if signature is None else signature
+
+        with self.lock:
+            self._evict(time.time())
+            candidates: set[typing.Hashable] = set()
+
+            for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+                candidates.update(bucket.get(band_key, ()))
+
+            results = [
+                (key, float(np.mean(self.entries[key][0] == signature)))
+                for key in candidates
+            ]
+
+        results = [(key, similarity) for key, similarity in results if similarity >= self.threshold]
+        return sorted(results, key=lambda item: item[1], reverse=True)
+
+class DuplicateProjectFilter:
+    """Reproves projects (reason 2) that are near-duplicates of recently approved ones, without calling the chain."""
+
+    reprovation_reason = 2
+
+    def __init__(
+            self,
+            index: MinHashLSHIndex,
+            owner: typing.Callable[[ProjectInput], typing.Hashable],
+            project_id: typing.Callable[[ProjectInput], typing.Hashable] | None = None):
+        self.index = index
+        # Projects are only compared with the ones of the same owner and private flag
+        self.owner = owner
+        # With the ids of the projects, a project evaluated again is not a duplicate of itself
+        self.project_id = project_id
+        self.anonymous_ids = itertools.count()
+        self.checked = 0
+        self.duplicates = 0
+
+    def scope(self, input: ProjectInput):
+        return (self.owner(input), input.private)
+
+    def check(self, input: ProjectInput):
+        """Return the reproval output when the project is a duplicate of another one, otherwise None."""
+        scope = self.scope(input)
+        own_key = (scope, self.project_id(input)) if self.project_id else None
+        matches = [
+            (similar_key, similarity)
+            for similar_key, similarity in self.index.query(input.format())
+            if similar_key[0] == scope and similar_key != own_key
+        ]
+        self.checked += 1
+
+        if not matches:
+            return None
+
+        self.duplicates += 1
+        (_, similar_key), similarity = matches[0]
+        return ProjectOutput(
+            prediction=ProjectPrediction(
+                approve=False,
+                reprovation_reason=self.reprovation_reason,
+                reprovation_comment='Projeto muito parecido ou idêntico a um projeto publicado recentemente.',
+            ),
+            info=ProjectInfo(
+                reasoning=f'Similaridade estimada de {similarity:.2f} com o projeto {similar_key}.',
+                confidence=similarity,
+                bot_generated=0,
+            ),
+        )
+
+    def record(self, input: ProjectInput, output: ProjectOutput):
+        """Index the project after its final decision (only approved projects are published)."""
+        if output.prediction.approve:
+            project_id = self.project_id(input) if self.project_id else f'anonymous-{next(self.anonymous_ids)}'
+            self.index.insert((self.scope(input), project_id), input.format())
+
+    def metrics(self):
+        return dict(
+            checked=self.checked,
+            duplicates=self.duplicates,
+            duplicate_rate=self.duplicates / self.checked if self.checked else 0.0,
+            indexed=len(self.index.entries))
+
+    def wrap(self, runnable: Runnable):
+        def invoke(input: ProjectInput):
+            output = self.check(input)
+
+            if output is None:
+                output = runnable.invoke(input)
+                self.record(input, output)
+
+            return output
+
+        async def ainvoke(input: ProjectInput):
+            output = await asyncio.to_thread(self.check, input)
+
+            if output is None:
+                output = await runnable.ainvoke(input)
+                await asyncio.to_thread(self.record, input, output)
+
+            return output
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+# ## Pipeline service
+
+import contextlib
+
+C = typing.TypeVar('C')
+
+def lazy_component(factory: typing.Callable[[typing.Any], C]) -> 'functools.cached_property[C]':
+    """A component of the service, created on its first access (only once, even with concurrent accesses)."""
+    name = factory.__name__
+
+    @functools.wraps(factory)
+    def create(service: typing.Any) -> C:
+        with service.locks.setdefault(name, threading.Lock()):
+            if name not in service.__dict__:
+                start = time.perf_counter()
+                service.__dict__[name] = factory(service)
+                service.timings[name] = time.perf_counter() - start
+
+        return service.__dict__[name]
+
+    return functools.cached_property(create)
+
+class PipelineService:
+    """The components of the pipeline, each created on its first use (or ahead of time with `warmup()`)."""
+
+    def __init__(
+            self,
+            env_path: str | None = '../.env',
+            with_examples: bool = True,
+            owner: typing.Callable[[ProjectInput], typing.Hashable] | None = None):
+        self.env_path = env_path
+        self.with_examples = with_examples
+        # The owner of each project, needed for the duplicates filter (disabled without it)
+        self.owner = owner
+        self.locks: dict[str, threading.Lock] = {}
+        self.timings: dict[str, float] = {}
+
+    @lazy_component
+    def environment(self):
+        return load_dotenv(self.env_path) if self.env_path else False
+
+    @lazy_component
+    def embeddings(self):
+        self.environment
+        return create_embeddings()
+
+    @lazy_component
+    def examples(self):
+        # Examples of a pretend task of creating antonyms.
+        return get_full_examples(100)
+
+    @lazy_component
+    def store_parts(self):
+        self.environment
+        stores, stores_handler = create_stores(self.embeddings)
+
+        if self.with_examples:
+            load_examples(stores, stores_handler, self.examples)
+            # Re-create the stores, so that the counts and indexes include the examples
+            stores, stores_handler = create_stores(self.embeddings)
+
+        return stores, stores_handler
+
+    @property
+    def stores(self) -> MyVectorStores:
+        return self.store_parts[0]
+
+    @property
+    def stores_handler(self) -> MyVectorStoreHandler:
+        return self.store_parts[1]
+
+    @lazy_component
+    def llm_cache(self):
+        return LLMResponseCache('./data/llm_cache.sqlite3')
+
+    @lazy_component
+    def chain(self):
+        self.environment
+        return create_chain(cache=self.llm_cache)
+
+    @lazy_component
+    def streaming_chain(self):
+        self.environment
+        return create_chain(streaming=True)
+
+    @lazy_component
+    def decision_cache(self):
+        return SemanticDecisionCache(self.embeddings)
+
+    @lazy_component
+    def cached_chain(self):
+        return self.decision_cache.wrap(self.chain)
+
+    @lazy_component
+    def prefilter(self):
+        return ProjectPrefilter(get_prefilter_rules())
+
+    @lazy_component
+    def duplicate_filter(self) -> DuplicateProjectFilter | None:
+        if self.owner is None:
+            return None
+
+        # Only projects published in the last week are considered for duplicates
+        return DuplicateProjectFilter(MinHashLSHIndex(max_age=7 * 24 * 60 * 60), self.owner)
+
+    @lazy_component
+    def approval_chain(self):
+        # Rules first, then the duplicates index (when the owners are known), then the decisions cache
+        # (near-identical projects reuse the decision already made) and only then the llm
+        if self.duplicate_filter is None:
+            chain = self.decision_cache.wrap(self.chain)
+        else:
+            chain = self.duplicate_filter.wrap(self.decision_cache.wrap(self.chain, serve_approvals=True))
+
+        return self.prefilter.wrap(chain)
+
+    def warmup(
+            self,
+            components: typing.Sequence[str] = ('store_parts', 'approval_chain', 'streaming_chain'),
+            background: bool = False):
+        """Create the components ahead of their first use (in a daemon thread, which is returned, with `background`)."""
+        def run():
+            for name in components:
+                getattr(self, name)
+
+        if not background:
+            run()
+            return None
+
+        thread = threading.Thread(target=run, name='pipeline-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    @contextlib.contextmanager
+    def override(self, **components: typing.Any):
+        """Use the given components instead of the service ones while active."""
+        missing = object()
+        previous = {name: self.__dict__.get(name, missing) for name in components}
+        self.__dict__.update(components)
+
+        try:
+            yield
+        finally:
+            for name, value in previous.items():
+                if value is missing:
+                    self.__dict__.pop(name, None)
+                else:
+                    self.__dict__[name] = value
+
+service = PipelineService()
 
 # ## Calculate the similarities
 
@@ -686,8 +3349,7 @@ from langchain.utils.math import cosine_similarity
 import numpy as np
 
 def get_similarity(str1: str, str2: str):
-    embed_1 = embeddings.embed_query(str1 or '')
-    embed_2 = embeddings.embed_query(str2 or '')
+    embed_1, embed_2 = service.embeddings.embed_vectors([str1 or '', str2 or ''])
     return cosine_similarity([embed_1], [embed_2])[0][0]
 
 def get_input_similarities(prediction: ProjectPrediction, input: ProjectInput):
@@ -704,8 +3366,8 @@ def get_input_similarities(prediction: ProjectPrediction, input: ProjectInput):
             description=input.description,
             private=input.private)
         
-        subcategory_1 = stores_handler.subcategories.get_by_id(pred_input.subcategory)
-        subcategory_2 = stores_handler.subcategories.get_by_id(input_to_compare.subcategory)
+        subcategory_1 = service.stores_handler.subcategories.get_by_id(pred_input.subcategory)
+        subcategory_2 = service.stores_handler.subcategories.get_by_id(input_to_compare.subcategory)
         subcategory_name_1 = subcategory_1.name if subcategory_1 else ''
         subcategory_name_2 = subcategory_2.name if subcategory_2 else ''
 
@@ -730,8 +3392,8 @@ def get_input_similarities(prediction: ProjectPrediction, input: ProjectInput):
 
 def get_output_similarities(prediction: ProjectPrediction, expected: ProjectPrediction):
     if expected.approve and prediction.approve:
-        subcategory_1 = stores_handler.subcategories.get_by_id(prediction.subcategory)
-        subcategory_2 = stores_handler.subcategories.get_by_id(expected.subcategory)
+        subcategory_1 = service.stores_handler.subcategories.get_by_id(prediction.subcategory)
+        subcategory_2 = service.stores_handler.subcategories.get_by_id(expected.subcategory)
         subcategory_name_1 = subcategory_1.name if subcategory_1 else ''
         subcategory_name_2 = subcategory_2.name if subcategory_2 else ''
 
@@ -750,8 +3412,8 @@ def get_output_similarities(prediction: ProjectPrediction, expected: ProjectPred
             description_similarity=description_similarity,
         )
     elif not expected.approve and not prediction.approve:
-        reprovation_reason_1 = stores_handler.reprovation_reasons.get_by_id(prediction.reprovation_reason)
-        reprovation_reason_2 = stores_handler.reprovation_reasons.get_by_id(expected.reprovation_reason)
+        reprovation_reason_1 = service.stores_handler.reprovation_reasons.get_by_id(prediction.reprovation_reason)
+        reprovation_reason_2 = service.stores_handler.reprovation_reasons.get_by_id(expected.reprovation_reason)
         reprovation_reason_name_1 = reprovation_reason_1.name if reprovation_reason_1 else ''
         reprovation_reason_name_2 = reprovation_reason_2.name if reprovation_reason_2 else ''
 
@@ -770,8 +3432,513 @@ def get_output_similarities(prediction: ProjectPrediction, expected: ProjectPred
     else:
         return dict(similarity=0)
 
+# ## Calculate the similarities in batch
+
+def get_names_by_id(handler: VectorStoreHandler, ids: typing.Iterable[int | None]):
+    unique_ids = [id for id in set(ids) if id is not None]
+    names: dict[int | None, str] = {None: ''}
+
+    for id, item in zip(unique_ids, handler.get_many(unique_ids)):
+        names[id] = item.name if item else ''
+
+    return names
+
+def get_normalized_embeddings(texts: list[str]):
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    vectors = service.embeddings.embed_vectors(texts)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def get_similarities_batch(
+        predictions: list[ProjectPrediction],
+        inputs: list[ProjectInput],
+        expected: list[ProjectPrediction] | None = None):
+    """Vectorized version of get_input_similarities and get_output_similarities (one numpy array per metric)."""
+    size = len(predictions)
+    expected_list = expected or []
+    texts: dict[str, int] = {}
+    pairs: list[tuple[str, int, int, int, float]] = []
+
+    def add_pair(column: str, row: int, str1: str | None, str2: str | None, weight: float = 1):
+        left = texts.setdefault(str1 or '', len(texts))
+        right = texts.setdefault(str2 or '', len(texts))
+        pairs.append((column, row, left, right, weight))
+
+    subcategory_names = get_names_by_id(
+        service.stores_handler.subcategories,
+        [item.subcategory for item in predictions + expected_list] + [item.subcategory for item in inputs])
+    reprovation_reason_names = get_names_by_id(
+        service.stores_handler.reprovation_reasons,
+        [item.reprovation_reason for item in predictions + expected_list])
+
+    input_columns = ['similarity', 'subcategory_similarity', 'title_similarity', 'description_similarity']
+    output_columns = input_columns + ['reprovation_reason_similarity', 'reprovation_comment_similarity']
+    result = {f'input_{name}': np.full(size, np.nan) for name in input_columns}
+
+    if expected is not None:
+        result.update({f'output_{name}': np.full(size, np.nan) for name in output_columns})
+
+    for row, (prediction, input) in enumerate(zip(predictions, inputs)):
+        if prediction.approve:
+            pred_input = ProjectInput(
+                subcategory=prediction.subcategory,
+                title=prediction.title,
+                description=prediction.description,
+                private=input.private)
+
+            input_to_compare = ProjectInput(
+                subcategory=input.subcategory,
+                title=input.title,
+                description=input.description,
+                private=input.private)
+
+            if pred_input.subcategory == input_to_compare.subcategory:
+                result['input_subcategory_similarity'][row] = 1
+            else:
+                add_pair(
+                    'input_subcategory_similarity', row,
+                    subcategory_names[pred_input.subcategory], subcategory_names[input_to_compare.subcategory], 0.5)
+
+            add_pair('input_title_similarity', row, pred_input.title, input_to_compare.title)
+            add_pair('input_description_similarity', row, pred_input.description, input_to_compare.description)
+            add_pair('input_similarity', row, pred_input.format(), input_to_compare.format())
+        else:
+            result['input_similarity'][row] = 1
+
+    for row, (prediction, expected_item) in enumerate(zip(predictions, expected_list)):
+        if expected_item.approve and prediction.approve:
+            if prediction.subcategory == expected_item.subcategory:
+                result['output_subcategory_similarity'][row] = 1
+            else:
+                add_pair(
+                    'output_subcategory_similarity', row,
+                    subcategory_names[prediction.subcategory], subcategory_names[expected_item.subcategory], 0.5)
+
+            add_pair('output_title_similarity', row, prediction.title, expected_item.title)
+            add_pair('output_description_similarity', row, prediction.description, expected_item.description)
+        elif not expected_item.approve and not prediction.approve:
+            if prediction.reprovation_reason == expected_item.reprovation_reason:
+                result['output_reprovation_reason_similarity'][row] = 1
+            else:
+                add_pair(
+                    'output_reprovation_reason_similarity', row,
+                    reprovation_reason_names[prediction.reprovation_reason],
+                    reprovation_reason_names[expected_item.reprovation_reason],
+                    0.5)
+
+            add_pair(
+                'output_reprovation_comment_similarity', row,
+                prediction.reprovation_comment, expected_item.reprovation_comment)
+        else:
+            result['output_similarity'][row] = 0
+
+    if pairs:
+        vectors = get_normalized_embeddings(list(texts))
+        lefts = np.array([left for _, _, left, _, _ in pairs])
+        rights = np.array([right for _, _, _, right, _ in pairs])
+        weights = np.array([weight for _, _, _, _, weight in pairs])
+        values = np.einsum('ij,ij->i', vectors[lefts], vectors[rights]) * weights
+
+        for (column, row, _, _, _), value in zip(pairs, values):
+            result[column][row] = value
+
+    if expected is not None:
+        approved = np.array([p.approve and e.approve for p, e in zip(predictions, expected_list)], dtype=bool)
+        reproved = np.array([not p.approve and not e.approve for p, e in zip(predictions, expected_list)], dtype=bool)
+
+        result['output_similarity'][approved] = np.mean([
+            result['output_subcategory_similarity'][approved],
+            result['output_title_similarity'][approved],
+            result['output_description_similarity'][approved],
+        ], axis=0)
+        result['output_similarity'][reproved] = (
+            9 * result['output_reprovation_reason_similarity'][reproved]
+            + result['output_reprovation_comment_similarity'][reproved]) / 10
+
+    return result
+
+# ## Evaluation
+
+import math
+
+class TokenBucket:
+    """Token bucket rate limiter (`rate` tokens per second, with bursts of up to `capacity` tokens)."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+async def retry_with_backoff(
+        fn: typing.Callable[[], typing.Awaitable[T]],
+        retries: int = 3,
+        base_delay: float = 1,
+        max_delay: float = 30) -> T:
+    for attempt in range(retries + 1):
+        try:
+            return await fn()
+        except Exception:
+            if attempt >= retries:
+                raise
+
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+
+    raise RuntimeError('unreachable')
+
+def read_evaluated_ids(path: str):
+    """Ids already evaluated without errors in a previous (possibly interrupted) run."""
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, encoding='utf-8') as file:
+        return {
+            data['id'] for data in (json.loads(line) for line in file if line.strip())
+            if not data.get('error')
+        }
+
+def json_value(value):
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else float(value)
+    return value
+
+async def evaluate(
+        items: typing.Iterable[tuple[int, ProjectInput, ProjectOutput]],
+        output_path: str,
+        runnable: Runnable | None = None,
+        concurrency: int = 8,
+        rate: float | None = None,
+        retries: int = 3,
+        score_batch_size: int = 64,
+        resume: bool = True):
+    """Run the chain over the items and score the predictions, writing one JSONL line per item (the checkpoint used by `resume`)."""
+    runnable = runnable or service.chain
+    done_ids = read_evaluated_ids(output_path) if resume else set()
+    bucket = TokenBucket(rate) if rate else None
+    queue: asyncio.Queue[tuple[int, ProjectInput, ProjectOutput, ProjectOutput | None, str | None] | None] = asyncio.Queue()
+    iterator = iter(items)
+    stats = dict(evaluated=0, errors=0, skipped=0)
+    similarities: list[float] = []
+
+    async def invoke(input: ProjectInput):
+        if bucket:
+            await bucket.acquire()
+        return await runnable.ainvoke(input)
+
+    async def worker():
+        for project_id, input, expected in iterator:
+            if project_id in done_ids:
+                stats['skipped'] += 1
+                continue
+
+            try:
+                predicted = await retry_with_backoff(lambda: invoke(input), retries=retries)
+                await queue.put((project_id, input, expected, predicted, None))
+            except Exception as e:
+                await queue.put((project_id, input, expected, None, repr(e)))
+
+    async def scorer(file: typing.TextIO):
+        finished = False
+
+        while not finished:
+            batch = [await queue.get()]
+
+            while len(batch) < score_batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            finished = None in batch
+            results = [item for item in batch if item is not None]
+            scored = [item for item in results if item[3] is not None]
+            columns = await asyncio.to_thread(
+                get_similarities_batch,
+                [predicted.prediction for _, _, _, predicted, _ in scored],
+                [input for _, input, _, _, _ in scored],
+                [expected.prediction for _, _, expected, _, _ in scored],
+            ) if scored else {}
+            row = 0
+
+            for project_id, input, expected, predicted, error in results:
+                line: dict[str, typing.Any] = dict(
+                    id=project_id,
+                    input=input.dict(),
+                    expected=expected.dict(),
+                    predicted=predicted.dict() if predicted else None,
+                    error=error,
+                )
+
+                if predicted:
+                    line['similarities'] = {name: json_value(values[row]) for name, values in columns.items()}
+                    row += 1
+                    similarities.append(line['similarities']['output_similarity'])
+                    stats['evaluated'] += 1
+                else:
+                    stats['errors'] += 1
+
+                file.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+            file.flush()
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as file:
+        scorer_task = asyncio.create_task(scorer(file))
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        await queue.put(None)
+        await scorer_task
+
+    return dict(**stats, output_similarity=float(np.mean(similarities)) if similarities else None)
+
+# ## Benchmark
+
+import shutil
+import subprocess
+import sys
+import tempfile
+from langchain_core.messages import HumanMessage, SystemMessage
+
+class StageTimer:
+    """Collects the durations (in seconds) of each stage of the pipeline."""
+
+    def __init__(self):
+        self.durations: dict[str, list[float]] = {}
+
+    def record(self, stage: str, seconds: float):
+        self.durations.setdefault(stage, []).append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def summary(self):
+        return {
+            stage: dict(
+                count=len(values),
+                total=float(np.sum(values)),
+                mean=float(np.mean(values)),
+                p50=float(np.percentile(values, 50)),
+                p95=float(np.percentile(values, 95)),
+                p99=float(np.percentile(values, 99)),
+                max=float(np.max(values)),
+            )
+            for stage, values in self.durations.items()
+        }
+
+@contextlib.contextmanager
+def use_stores(new_stores: MyVectorStores, new_stores_handler: MyVectorStoreHandler):
+    """Make the prompt functions use the given stores while active."""
+    with service.override(store_parts=(new_stores, new_stores_handler)):
+        yield
+
+def create_benchmark_stores(store_size: int, path: str, backend: str | None = None):
+    """Stores (created in `path`, like the ones of the service) with the reference data and `store_size` synthetic projects."""
+    benchmark_stores, benchmark_handler = create_stores(service.embeddings, path, backend)
+
+    load_examples(benchmark_stores, benchmark_handler, get_full_examples(store_size))
+
+    # Re-create the stores, so that the counts and indexes include the projects
+    return create_stores(service.embeddings, path, backend)
+
+async def benchmark_pipeline(
+        amount: int = 100,
+        concurrency: int = 8,
+        store_size: int = 1000,
+        llm: BaseLanguageModel | None = None,
+        output_path: str | None = None,
+        backend: str | None = None):
+    """Run `amount` synthetic projects through the pipeline (with a fake llm by default) and report the latency of each stage."""
+    benchmark_path = tempfile.mkdtemp(prefix='benchmark_')
+    benchmark_backend = backend or os.getenv('PROJECTS_STORE_BACKEND', 'chroma')
+    benchmark_stores, benchmark_handler = create_benchmark_stores(store_size, benchmark_path, benchmark_backend)
+    _, benchmark_llm, benchmark_parser = create_chain_parts(chat=True, llm=llm or FakeApprovalChatModel())
+    projects = [get_projects_approvation_full(store_size + idx) for idx in range(amount)]
+    timer = StageTimer()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(input: ProjectInput, expected: ProjectOutput):
+        async with semaphore:
+            start = time.perf_counter()
+            input_query = input.format()
+
+            # Same steps as `system_prompt`, each timed alone (the embedding without its cache)
+            with QueryEmbeddings(service.embeddings.embeddings) as query_embeddings:
+                with timer.measure('embedding'):
+                    await query_embeddings.aembed(input_query)
+
+                async def search(name: str, section: typing.Awaitable[str]):
+                    with timer.measure(f'search_{name}'):
+                        return await section
+
+                subcategories, reprovation_reasons, examples = await asyncio.gather(
+                    search('subcategories', subcategories_prompt(input_query, k=50)),
+                    search('reprovation_reasons', reprovation_reasons_prompt(input_query, k=50)),
+                    search('examples', examples_prompt(
+                        input_query, k=20, input=input, token_budget=examples_token_budget)),
+                )
+
+            with timer.measure('system_prompt'):
+                messages = [
+                    SystemMessage(content=get_compiled_system_prompt(benchmark_parser).render(
+                        subcategories=subcategories,
+                        reprovation_reasons=reprovation_reasons,
+                        examples=examples)),
+                    HumanMessage(content=user_prompt(input)),
+                ]
+
+            with timer.measure('llm'):
+                message = await benchmark_llm.ainvoke(messages)
+
+            with timer.measure('parser'):
+                output = benchmark_parser.invoke(message)
+
+            with timer.measure('scoring'):
+                get_similarities_batch([output.prediction], [input], [expected.prediction])
+
+            timer.record('total', time.perf_counter() - start)
+
+    try:
+        with use_stores(benchmark_stores, benchmark_handler):
+            start = time.perf_counter()
+            await asyncio.gather(*[run(input, expected) for _, input, expected in projects])
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(benchmark_path, ignore_errors=True)
+
+    result = dict(
+        amount=amount,
+        concurrency=concurrency,
+        store_size=store_size,
+        backend=benchmark_backend,
+        llm=type(benchmark_llm).__name__,
+        elapsed=elapsed,
+        throughput=amount / elapsed if elapsed else None,
+        stages=timer.summary(),
+    )
+
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+
+        with open(output_path, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=2)
+
+    return result
+
+# Components in dependency order, so that each one is timed alone
+startup_components = (
+    'environment',
+    'embeddings',
+    'examples',
+    'store_parts',
+    'llm_cache',
+    'chain',
+    'streaming_chain',
+    'decision_cache',
+    'cached_chain',
+    'prefilter',
+    'duplicate_filter',
+    'approval_chain',
+)
+
+def measure_startup(components: typing.Sequence[str] = startup_components, with_examples: bool = True):
+    """Time the creation of each component of a new service."""
+    startup_service = PipelineService(env_path=service.env_path, with_examples=with_examples, owner=service.owner)
+    durations: dict[str, float] = {}
+
+    for name in components:
+        start = time.perf_counter()
+        getattr(startup_service, name)
+        durations[name] = time.perf_counter() - start
+
+    return durations
+
+def benchmark_startup(
+        components: typing.Sequence[str] = startup_components,
+        with_examples: bool = True,
+        output_path: str | None = None):
+    """Measure the cold start of the pipeline (the import of this module and the creation of each component) in a new process."""
+    module_dir, module_file = os.path.split(os.path.abspath(__file__))
+    module_name = os.path.splitext(module_file)[0]
+    code = '\n'.join([
+        'import json, sys, time',
+        f'sys.path.insert(0, {module_dir!r})',
+        'start = time.perf_counter()',
+        f'import {module_name} as module',
+        'imported = time.perf_counter() - start',
+        f'durations = module.measure_startup({list(components)!r}, with_examples={with_examples!r})',
+        'print(json.dumps(dict(import_seconds=imported, components=durations)))',
+    ])
+
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', code], cwd=module_dir, capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result.update(
+        components_seconds=sum(result['components'].values()),
+        process_seconds=elapsed)
+
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+
+        with open(output_path, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=2)
+
+    return result
+
 # ## Tests
 
+def test_prefilter():
+    # (title, description, expected reprovation reason or None when left to the chain)
+    cases = [
+        ('Logo para empresa', 'Teste não pago antes de fechar o projeto.', 8),
+        ('Vendedor', 'Pagamento somente por comissão.', 7),
+        ('Vendedor', 'Comissionado não, pagamento fixo por projeto.', None),
+        ('Desenvolvedor', 'Vaga de emprego com carteira assinada.', 10),
+        ('Site institucional', 'Não é vaga de emprego, é um projeto pontual.', None),
+        ('Design de logo', 'Ofereço permuta pelos serviços.', 9),
+        ('Design de logo', 'Pagamento em dinheiro, sem permuta.', None),
+        ('Design de logo', 'Preciso de um logo moderno para a minha empresa.', None),
+        ('Revisão de texto', 'O trabalho será voluntário, para uma ONG.', 8),
+        ('Vendedor', 'O pagamento será por comissão sobre as vendas.', 7),
+        ('Desenvolvedor', 'Contrato CLT para trabalhar presencialmente.', 10),
+        ('Design de logo', 'Aceito permuta, tenho uma gráfica.', 9),
+        # Projects about these subjects (not offering them)
+        ('Portal de vagas', 'Desenvolver um portal de vagas de emprego para a minha cidade.', None),
+        ('Sistema de vendas', 'Sistema para calcular o pagamento de vendedores comissionados.', None),
+        ('Site de imobiliária', 'Site de imobiliária com anúncios de venda, aluguel e permuta de imóveis.', None),
+        ('Planilha', 'Planilha de folha de pagamento para funcionários com carteira assinada.', None),
+        ('Artigo', 'Artigo sobre os benefícios do trabalho voluntário.', None),
+    ]
+    project_prefilter = ProjectPrefilter(get_prefilter_rules())
+
+    for title, description, expected in cases:
+        output = project_prefilter.check(ProjectInput(subcategory=0, title=title, description=description))
+        reason = output.prediction.reprovation_reason if output else None
+        assert reason == expected, f'{description!r}: expected {expected}, got {reason}'
+
+    print(f'Prefilter: {len(cases)} cases passed')
+
 def test_similarity(str1: str, str2: str):
     similarity = get_similarity(str1, str2)
     print(f'Similarity between "{str1}" and "{str2}": {similarity:.4f}')
@@ -784,7 +3951,7 @@ async def invoke_and_show_similarities(input: ProjectInput, output_expected: Pro
     print('Output Expected:')
     print(output_expected)
 
-    output_predicted = await chain.ainvoke(input)
+    output_predicted = await service.chain.ainvoke(input)
 
     print()
     print('Output Predicted:')
@@ -809,11 +3976,15 @@ async def invoke_and_show_similarities(input: ProjectInput, output_expected: Pro
     print()
 
 async def fn_main():
+    test_prefilter()
+
     print('-' * 50)
     print('Examples:')
     print('-' * 50)
 
-    [await invoke_and_show_similarities(input=input, output_expected=output_expected) for _, input, output_expected in examples[:5]]
+    # The demo evaluates the examples again on every run (instead of resuming from the last one)
+    stats = await evaluate(service.examples[:5], output_path='./data/evaluation.jsonl', concurrency=5, resume=False)
+    print(stats)
 
     print('-' * 50)
     print('Correct Example:')
@@ -846,8 +4017,8 @@ async def fn_main():
     print('Incorrect Example:')
     print('-' * 50)
 
-    prediction = examples[0][2].prediction
-    input = examples[3][1]
+    prediction = service.examples[0][2].prediction
+    input = service.examples[3][1]
 
     print('Input:')
     print(input)
@@ -864,8 +4035,8 @@ async def fn_main():
     print('Input Similarities:')
     print(input_similarities)
 
-    prediction = examples[0][2].prediction
-    expected = examples[3][2].prediction
+    prediction = service.examples[0][2].prediction
+    expected = service.examples[3][2].prediction
 
     print()
     print('Output Expected:')
@@ -885,5 +4056,25 @@ async def fn_main():
 
     print()
 
-import asyncio
-asyncio.run(fn_main())
+import argparse
+
+def main(argv: list[str] | None = None):
+    arg_parser = argparse.ArgumentParser(description='Project approvals demo.')
+    commands = arg_parser.add_subparsers(dest='command')
+    commands.add_parser('demo', help='Run the examples (default).')
+    ingest_parser = commands.add_parser('ingest', help='Upsert the projects of a JSONL file (with id, input and output) in the stores.')
+    ingest_parser.add_argument('path')
+    ingest_parser.add_argument('--batch-size', type=int, default=500)
+    args = arg_parser.parse_args(argv)
+
+    if args.command == 'ingest':
+        service.with_examples = False
+        print(json.dumps(ingest_projects_file(args.path, batch_size=args.batch_size)))
+        return
+
+    service.warmup()
+    print_examples(service.stores_handler)
+    asyncio.run(fn_main())
+
+if __name__ == '__main__':
+    main()